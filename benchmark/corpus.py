@@ -0,0 +1,111 @@
+import random
+
+TYPE_NAMESPACE = "http://benchmark.example.org/"
+VALUE_KINDS = ["integer", "decimal", "word", "code", "date"]
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ze", "an", "el", "or", "us", "in", "ep"]
+
+
+class SyntheticCorpus(object):
+    """
+    Generates semantic types, columns and bulk add models at a configurable scale.  Each semantic type gets its own
+    kind of values (numbers in a range, words from a vocabulary, codes with a prefix, ...) so the columns of a type
+    look alike and predicting them means something.  The same seed always generates the same corpus.
+    """
+
+    def __init__(self, types=20, columns=5, values=200, seed=0):
+        """
+        :param types:   The number of semantic types
+        :param columns: The number of columns in each semantic type
+        :param values:  The number of values in each column
+        :param seed:    Seed for the random number generator
+        """
+        self.types = types
+        self.columns = columns
+        self.values = values
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.type_specs = [self._type_spec(i) for i in range(types)]
+
+    def _word(self):
+        return "".join(self.random.choice(SYLLABLES) for _ in range(self.random.randint(2, 4)))
+
+    def _type_spec(self, i):
+        spec = {
+            "class": TYPE_NAMESPACE + "Class" + str(i // 4),
+            "property": "property" + str(i),
+            "kind": VALUE_KINDS[i % len(VALUE_KINDS)],
+            "low": self.random.randint(0, 1000),
+            "prefix": "".join(self.random.choice("ABCDEFGHJKLMNPQRSTUVWXYZ") for _ in range(3)),
+            "vocabulary": [self._word() for _ in range(50)]
+        }
+        spec["high"] = spec["low"] + self.random.randint(10, 100000)
+        return spec
+
+    def value(self, spec):
+        """
+        Returns one random value of a semantic type.
+
+        :param spec: The type spec from type_specs
+        :return: The value as a string
+        """
+        kind = spec["kind"]
+        if kind == "integer":
+            return str(self.random.randint(spec["low"], spec["high"]))
+        if kind == "decimal":
+            return "%.2f" % self.random.uniform(spec["low"], spec["high"])
+        if kind == "word":
+            return " ".join(self.random.choice(spec["vocabulary"]) for _ in range(self.random.randint(1, 3)))
+        if kind == "code":
+            return spec["prefix"] + "-" + str(self.random.randint(spec["low"], spec["high"]))
+        return "%04d-%02d-%02d" % (self.random.randint(1900, 2030), self.random.randint(1, 12),
+                                   self.random.randint(1, 28))
+
+    def column_values(self, spec, count=None):
+        """
+        Returns a list of random values of a semantic type.
+
+        :param spec:  The type spec from type_specs
+        :param count: The number of values, the corpus' values per column if this is None
+        :return: A list of the values
+        """
+        return [self.value(spec) for _ in range(self.values if count is None else count)]
+
+    def columns_of_type(self, spec):
+        """
+        Returns the columns of a semantic type in the form (column_name, source_name, values).
+
+        :param spec: The type spec from type_specs
+        """
+        for c in range(self.columns):
+            yield "column_" + spec["property"] + "_" + str(c), "source_" + str(c), self.column_values(spec)
+
+    def bulk_add_model(self, model_id, nodes):
+        """
+        Returns a bulk add model (model.json) with one node for each of the first nodes semantic types.
+
+        :param model_id: The id of the model
+        :param nodes:    The number of nodes in the model
+        :return: The model as a dictionary
+        """
+        return {
+            "id": model_id,
+            "name": "benchmark_" + model_id,
+            "description": "Synthetic benchmark model",
+            "graph": {
+                "nodes": [{
+                    "columnName": "node_" + str(i),
+                    "userSemanticTypes": [{"domain": {"uri": spec["class"]}, "type": {"uri": spec["property"]}}]
+                } for i, spec in enumerate(self.type_specs[:nodes])]
+            }
+        }
+
+    def bulk_add_rows(self, nodes, rows):
+        """
+        Returns the json lines rows for a model made by bulk_add_model.
+
+        :param nodes: The number of nodes in the model
+        :param rows:  The number of rows
+        :return: A list of dictionaries, one for each row
+        """
+        return [dict(("node_" + str(i), self.value(spec)) for i, spec in enumerate(self.type_specs[:nodes]))
+                for _ in range(rows)]
@@ -0,0 +1,251 @@
+"""
+Benchmarks the Server methods on a synthetic corpus, using local stand-ins for MongoDB (mongomock) and Elasticsearch
+(the in-process search backend), so the results only depend on the code and the machine.
+
+Usage:
+    python -m benchmark.run --types 20 --columns 5 --values 200 --output results.json
+    python -m benchmark.run --output new.json --compare results.json
+"""
+import argparse
+import collections
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+# The search backend is chosen when the service package is imported
+os.environ["SEARCH_BACKEND"] = "memory"
+
+import mongomock
+
+from benchmark.corpus import TYPE_NAMESPACE, SyntheticCorpus
+import service.serverLogic
+from service import *
+from service.jobs import JobQueue
+from service.serverLogic import Server
+
+
+def _status(result):
+    """
+    Returns the status code of whatever a Server method returned.
+    """
+    if isinstance(result, tuple):
+        return result[1]
+    return result.status_code
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def _peak_memory_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes but macOS reports bytes
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def _scenario_memory_kb(calls, after_fork):
+    """
+    Makes the calls in a forked child process and returns the child's peak memory.  The peak of this process is the
+    largest since it started, so it can't tell one scenario from another, but a child's peak starts out at the memory
+    in use when it was forked.
+
+    :param calls:      Iterable of functions with no arguments
+    :param after_fork: Function called in the child before the calls
+    :return: The peak memory of the child and how much that is above what it started with in the form (peak, growth),
+             or (None, None) where there is no fork
+    """
+    if not hasattr(os, "fork"):
+        return None, None
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            after_fork()
+            start = _peak_memory_kb()
+            for call in calls:
+                call()
+            peak = _peak_memory_kb()
+            os.write(write_fd, "%d %d" % (peak, peak - start))
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        measured = f.read().split()
+    os.waitpid(pid, 0)
+    if len(measured) != 2:
+        return None, None
+    return int(measured[0]), int(measured[1])
+
+
+class Benchmark(object):
+    """
+    Runs each of the scenarios and collects their latencies.
+    """
+
+    def __init__(self, corpus, iterations, append_values, models, model_rows):
+        self.corpus = corpus
+        self.iterations = iterations
+        self.append_values = append_values
+        self.models = models
+        self.model_rows = model_rows
+        self.server = Server(lazy_startup=False, mongo_client=mongomock.MongoClient())
+        self.results = collections.OrderedDict()
+        self.column_ids = []
+
+    def _wait_for_crunches(self, timeout=60):
+        # A child forked while a background job holds a lock would never see it released
+        deadline = time.time() + timeout
+        while self.server.models.count_documents({CRUNCH_PENDING: True}) and time.time() < deadline:
+            time.sleep(0.05)
+
+    def _restart_threads(self):
+        # Only the thread which forked exists in a child, so the thread pools and job workers are started again
+        service.serverLogic.search_pool = ThreadPool(SEARCH_THREADS)
+        service.serverLogic.crunch_pool = ThreadPool(CRUNCH_THREADS)
+        self.server.jobs = JobQueue()
+
+    def _measure(self, name, scenario):
+        """
+        Calls each of the functions of a scenario and records how long each one took.  The scenario is run once in a
+        forked child process beforehand to measure its memory, then again here for the latencies.
+
+        :param name:     Name of the scenario
+        :param scenario: Function which returns an iterable of functions with no arguments, it is called once for the
+                         memory and once for the latencies
+        """
+        self._wait_for_crunches()
+        peak_memory, memory_growth = _scenario_memory_kb(scenario(), self._restart_threads)
+        calls = scenario()
+        latencies = []
+        errors = 0
+        start = time.time()
+        for call in calls:
+            call_start = time.time()
+            status = _status(call())
+            latencies.append(time.time() - call_start)
+            if status >= 400:
+                errors += 1
+        total = time.time() - start
+        latencies.sort()
+        o = collections.OrderedDict()
+        o["operations"] = len(latencies)
+        o["errors"] = errors
+        o["total_seconds"] = total
+        o["throughput_per_second"] = len(latencies) / total if total > 0 else None
+        o["p50_ms"] = _percentile(latencies, 50) * 1000 if latencies else None
+        o["p95_ms"] = _percentile(latencies, 95) * 1000 if latencies else None
+        o["p99_ms"] = _percentile(latencies, 99) * 1000 if latencies else None
+        o["peak_memory_kb"] = peak_memory
+        o["memory_growth_kb"] = memory_growth
+        self.results[name] = o
+        print(("%-24s %8d ops %10.1f ops/s  p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms  peak %8d kb (+%d kb)  "
+               "%d errors") % (
+            name, o["operations"], o["throughput_per_second"] or 0, o["p50_ms"] or 0, o["p95_ms"] or 0,
+            o["p99_ms"] or 0, peak_memory or 0, memory_growth or 0, errors))
+
+    def _column_creates(self):
+        for spec in self.corpus.type_specs:
+            type_id = self.server.semantic_types_post_put(spec["class"], spec["property"])[0]
+            for column_name, source_name, values in self.corpus.columns_of_type(spec):
+                self.column_ids.append((spec, get_column_id(type_id, column_name, source_name, DEFAULT_MODEL)))
+                yield lambda t=type_id, c=column_name, s=source_name, v=values: \
+                    self.server.semantic_types_columns_post_put(t, c, s, DEFAULT_MODEL, v)
+
+    def _column_appends(self):
+        for spec, column_id in self.column_ids:
+            values = self.corpus.column_values(spec, self.append_values)
+            yield lambda c=column_id, v=values: self.server.semantic_types_column_data_post_put(c, v)
+
+    def _semantic_types_gets(self):
+        for i in range(self.iterations):
+            if i % 2:
+                yield lambda: self.server.semantic_types_get(return_columns=True)
+            else:
+                yield lambda: self.server.semantic_types_get(namespaces=[TYPE_NAMESPACE.rstrip("/")])
+
+    def _predicts(self):
+        for _ in range(self.iterations):
+            # New values every time, so the prediction cache doesn't answer any of them
+            values = self.corpus.column_values(self.corpus.random.choice(self.corpus.type_specs))
+            yield lambda v=values: self.server.predict_post(iter(v), column_names=[DEFAULT_NAME])
+
+    def _bulk_add_model_creates(self):
+        for i in range(self.models):
+            model = self.corpus.bulk_add_model("model_" + str(i), len(self.corpus.type_specs))
+            yield lambda m=model: self.server.bulk_add_models_post(m)
+
+    def _bulk_add_model_data(self):
+        for i in range(self.models):
+            rows = self.corpus.bulk_add_rows(len(self.corpus.type_specs), self.model_rows)
+            yield lambda m="model_" + str(i), r=rows: self.server.bulk_add_model_data_post(m, DEFAULT_BULK_MODEL, r)
+
+    def run(self):
+        self._measure("column_create", self._column_creates)
+        self._measure("column_append", self._column_appends)
+        self._measure("semantic_types_get", self._semantic_types_gets)
+        self._measure("predict", self._predicts)
+        self._measure("bulk_add_model_create", self._bulk_add_model_creates)
+        self._measure("bulk_add_model_data", self._bulk_add_model_data)
+        return self.results
+
+
+def compare(results, baseline):
+    """
+    Prints how each scenario changed compared to an earlier run.
+
+    :param results:  The results of this run
+    :param baseline: The results of the earlier run
+    """
+    print("\n%-24s %14s %14s" % ("compared to baseline", "throughput", "p95"))
+    for name, result in results.items():
+        old = baseline.get("results", {}).get(name)
+        if not old or not old.get("throughput_per_second") or not old.get("p95_ms"):
+            continue
+        print("%-24s %+13.1f%% %+13.1f%%" % (
+            name, 100.0 * (result["throughput_per_second"] / old["throughput_per_second"] - 1),
+            100.0 * (result["p95_ms"] / old["p95_ms"] - 1)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the semantic labeling service")
+    parser.add_argument("--types", type=int, default=20, help="Number of semantic types")
+    parser.add_argument("--columns", type=int, default=5, help="Number of columns in each semantic type")
+    parser.add_argument("--values", type=int, default=200, help="Number of values in each column")
+    parser.add_argument("--iterations", type=int, default=50, help="Number of predicts and semantic type gets")
+    parser.add_argument("--append-values", type=int, default=50, help="Number of values appended to each column")
+    parser.add_argument("--models", type=int, default=2, help="Number of bulk add models")
+    parser.add_argument("--model-rows", type=int, default=500, help="Number of rows of data for each bulk add model")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for generating the corpus")
+    parser.add_argument("--output", default="benchmark_results.json", help="File to save the results to")
+    parser.add_argument("--compare", help="Results of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    corpus = SyntheticCorpus(args.types, args.columns, args.values, args.seed)
+    results = Benchmark(corpus, args.iterations, args.append_values, args.models, args.model_rows).run()
+
+    output = collections.OrderedDict()
+    output["config"] = vars(args)
+    output["environment"] = {"python": platform.python_version(), "platform": platform.platform(),
+                             "search_backend": SEARCH_BACKEND, "predict_processes": PREDICT_PROCESSES}
+    output["results"] = results
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=4)
+    print("\nResults saved to " + args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,39 @@
+import logging
+import time
 import traceback
 
-from flask import Flask, request
+from flask import Flask, g, request
 from flask_cors import CORS
 from flask_restful import Api, Resource
 from flask_restful_swagger import swagger
 
 import service.serverLogic
 from service import *
+from service.metrics import http_request_duration, http_requests
 
 app = Flask(__name__, static_folder='../static')
 api = swagger.docs(Api(app), apiVersion='0.2', basePath='/', resourcePath='/',
                    produces=["application/json", "text/html"], api_spec_url='/api/spec', description='Semantic Typing')
 CORS(app)
+logging.basicConfig(level=logging.INFO)
 service = service.serverLogic.Server()
 
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.time()
+
+
+@app.after_request
+def record_request_metrics(response):
+    # flask_restful names each endpoint after its Resource class
+    resource = request.endpoint or "unknown"
+    http_requests.inc((resource, request.method, response.status_code))
+    if hasattr(g, "request_start"):
+        http_request_duration.observe(time.time() - g.request_start, (resource, request.method))
+    return response
+
+
 ################################################################################################################################
 #
 #           #
@@ -229,6 +248,41 @@ class parameters(object):
             "paramType": "query"
         }
 
+    @staticmethod
+    def background():
+        return {
+            "name": BACKGROUND,
+            "description": "If this is true, a 202 is returned with a job right away and the data is added in the "
+                           "background, use GET /jobs/{job_id} to follow it",
+            "required": False,
+            "allowMultiple": False,
+            "dataType": "boolean",
+            "paramType": "query"
+        }
+
+    @staticmethod
+    def wait_for_visibility():
+        return {
+            "name": WAIT_FOR_VISIBILITY,
+            "description": "If this is true, the response isn't sent until predicts can see the new data, otherwise "
+                           "it can take about a second",
+            "required": False,
+            "allowMultiple": False,
+            "dataType": "boolean",
+            "paramType": "query"
+        }
+
+    @staticmethod
+    def job_id():
+        return {
+            "name": JOB_ID_PATH,
+            "description": "Id of the job",
+            "required": True,
+            "allowMultiple": False,
+            "dataType": "string",
+            "paramType": "path"
+        }
+
 
 class responses(object):
     @staticmethod
@@ -267,6 +321,64 @@ class responses(object):
         ]
 
 
+class Metrics(Resource):
+    @swagger.operation(
+        responseMessages=[
+            {"code": 200, "message": "Success"},
+            {"code": 500, "message": "Internal Server Error"}
+        ]
+    )
+    def get(self):
+        """
+        Get the service metrics
+        Returns the metrics of the service in the prometheus text format.  This includes the number and latency of
+        the requests to each resource, how long each stage of predicting takes (preparing the data, the types search,
+        the text search and the classifier), the number and duration of the MongoDB operations done by each Server
+        method and the prediction cache hits and misses.
+        """
+        try:
+            if len(request.args) > 0: return "Invalid arguments, there should be none", 400
+            return service.metrics_get()
+        except:
+            return str(traceback.format_exc()), 500
+
+
+class Ready(Resource):
+    @swagger.operation(
+        responseMessages=[
+            {"code": 200, "message": "Ready"},
+            {"code": 503, "message": "Still warming up"},
+            {"code": 500, "message": "Internal Server Error"}
+        ]
+    )
+    def get(self):
+        """
+        Check if the service is ready
+        Returns a 200 once the model is loaded and a warm up prediction has run, until then a 503 is returned.  Use
+        this as the readiness check when the service is started with LAZY_STARTUP=true.  Returned body will have the
+        following format, with how long each startup phase took in seconds:
+        <pre>
+        {
+            "ready": true,
+            "startupTimes": {
+                "db connection": 0.012,
+                "db indexes": 0.034,
+                "model": 1.52,
+                "source catalog": 0.021,
+                "bulk add model catalog": 0.004,
+                "search backend": 0.087,
+                "warm up prediction": 0.156
+            }
+        }
+        </pre>
+        """
+        try:
+            if len(request.args) > 0: return "Invalid arguments, there should be none", 400
+            return service.ready_get()
+        except:
+            return str(traceback.format_exc()), 500
+
+
 class Predict(Resource):
     @swagger.operation(
         parameters=[
@@ -292,10 +404,9 @@ class Predict(Resource):
         ]
         </pre>
         """
-        # print("request data", request.data)
         try:
-            # print("request data", request.data)
-            if request.data is None or request.data == "": return "Invalid message body", 400
+            # The body is streamed into predict_post so don't touch request.data here
+            if request.content_length == 0: return "Invalid message body", 400
             args = request.args.copy()
             namespaces = args.pop(NAMESPACES).split(",") if args.get(NAMESPACES) else None
             column_names = args.pop(COLUMN_NAME).split(",") if args.get(COLUMN_NAME) else None
@@ -303,9 +414,103 @@ class Predict(Resource):
             models = args.pop(MODEL).split(",") if args.get(MODEL) else None
             if len(args) > 0: return "The following query parameters are invalid:  " + str(args.keys()), 400
             if column_names is None: column_names = [DEFAULT_NAME]
-            return service.predict_post(request.data.splitlines(), namespaces, column_names, source_names, models)
-        except Exception as e:
-            print(e)
+            return service.predict_post(request.stream, namespaces, column_names, source_names, models)
+        except:
+            return str(traceback.format_exc()), 500
+
+
+class PredictCache(Resource):
+    @swagger.operation(
+        responseMessages=responses.standard_get()
+    )
+    def get(self):
+        """
+        Get the prediction cache stats
+        Returns how full the prediction cache is and how many predicts were served from it.  Returned body will have
+        the following format:
+        <pre>
+        {
+            "size": ,
+            "maxSize": ,
+            "hits": ,
+            "misses": ,
+            "epoch":
+        }
+        </pre>
+        """
+        try:
+            if len(request.args) > 0: return "Invalid arguments, there should be none", 400
+            return service.predict_cache_get()
+        except:
+            return str(traceback.format_exc()), 500
+
+
+class PredictBatch(Resource):
+    @swagger.operation(
+        parameters=[
+            parameters.body(True, "JSON document with the columns to predict and the (optional) filters shared by all "
+                                  "of them")
+        ],
+        responseMessages=responses.standard_get()
+    )
+    def post(self):
+        """
+        Predict the semantic types of many columns
+        Predicts the semantic type of each of the given columns in one request.  The source names, namespace and model
+        filters are shared by all of the columns.  The body should have the following format, where only "columns" is
+        required:
+        <pre>
+        {
+            "namespaces": [],
+            "sourceNames": [],
+            "models": [],
+            "columns": [
+                {
+                    "columnName": "",
+                    "data": [
+                        "",
+                        ""
+                    ]
+                }
+            ]
+        }
+        </pre>
+        Returns a list with an entry for each column in the same order they were given in the following format (the
+        predictions are sorted from most to least likely):
+        <pre>
+        [
+            {
+                "columnName": "",
+                "predictions": [
+                    {
+                        "type_id": "",
+                        "score":
+                    }
+                ]
+            }
+        ]
+        </pre>
+        Data values which are numbers or booleans are predicted as their text and nulls are skipped.  If a column has
+        no data, it will have an "error" instead of "predictions".
+        """
+        try:
+            if request.data is None or request.data == "": return "Invalid message body", 400
+            if len(request.args) > 0: return "Invalid arguments, there should be none", 400
+            try:
+                body = json.loads(request.data)
+            except ValueError:
+                return "Invalid message body", 400
+            if not isinstance(body, dict) or not isinstance(body.get(COLUMNS), list) or len(body[COLUMNS]) < 1:
+                return "The body must have a non-empty list of 'columns'", 400
+            for col in body[COLUMNS]:
+                if not isinstance(col, dict) or not isinstance(col.get(DATA, []), list):
+                    return "Each column must be an object with a list of 'data'", 400
+                if any(isinstance(value, (dict, list)) for value in col.get(DATA) or []):
+                    return "The data of column '%s' must only have strings, numbers, booleans or nulls" % \
+                           (col.get(COLUMN_NAME) or DEFAULT_NAME), 400
+            return service.predict_batch_post(body[COLUMNS], body.get(NAMESPACES), body.get(SOURCE_NAMES),
+                                              body.get(MODELS))
+        except:
             return str(traceback.format_exc()), 500
 
 
@@ -719,6 +924,7 @@ class SemanticTypeColumnData(Resource):
     @swagger.operation(
         parameters=[
             # parameters.column_ids(True, "The ids of the column to add the data to", False, "path"),
+            parameters.wait_for_visibility(),
             parameters.body(True)
         ],
         responseMessages=responses.standard_post()
@@ -731,14 +937,19 @@ class SemanticTypeColumnData(Resource):
         try:
             if request.data is None or request.data == "": return "Invalid message body", 400
             if column_id is None or len(column_id) < 1: return "Invalid column_id", 400
-            if len(request.args) > 0: return "Invalid arguments, there should be none", 400
-            return service.semantic_types_column_data_post_put(column_id, request.data, False)
+            args = request.args.copy()
+            wait_for_visibility = args.pop(WAIT_FOR_VISIBILITY, None)
+            if len(args) > 0: return "The following query parameters are invalid:  " + str(args.keys()), 400
+            wait_for_visibility = wait_for_visibility is not None and wait_for_visibility.lower() == "true"
+            return service.semantic_types_column_data_post_put(column_id, request.data.split("\n"), False,
+                                                               wait_for_visibility)
         except:
             return str(traceback.format_exc()), 500
 
     @swagger.operation(
         parameters=[
             # parameters.column_ids(True, "The ids of the column to add the data to", False, "path"),
+            parameters.wait_for_visibility(),
             parameters.body(True)
         ],
         responseMessages=responses.standard_put()
@@ -751,8 +962,12 @@ class SemanticTypeColumnData(Resource):
         try:
             if request.data is None or request.data == "": return "Invalid message body", 400
             if column_id is None or len(column_id) < 1: return "Invalid column_id", 400
-            if len(request.args) > 0: return "Invalid arguments, there should be none", 400
-            return service.semantic_types_column_data_post_put(column_id, request.data, True)
+            args = request.args.copy()
+            wait_for_visibility = args.pop(WAIT_FOR_VISIBILITY, None)
+            if len(args) > 0: return "The following query parameters are invalid:  " + str(args.keys()), 400
+            wait_for_visibility = wait_for_visibility is not None and wait_for_visibility.lower() == "true"
+            return service.semantic_types_column_data_post_put(column_id, request.data.split("\n"), True,
+                                                               wait_for_visibility)
         except:
             return str(traceback.format_exc()), 500
 
@@ -890,7 +1105,9 @@ class BulkAddModelData(Resource):
         Returns the current state of the given bulk add model id.  If doNotCrunchDataNow is true, the learned
         semantic types will not be generated now, instead whatever is in the db will be used, which may or may not be
         current.  Every time a GET is run on a model with this set to false (or not given at all) the model in the db
-        will be updated as well as returned.
+        will be updated as well as returned.  Adding data to the model's columns also updates it in the background,
+        crunchedAt is when the learned semantic types were last generated and crunchPending is true until the update
+        is done.
         """
         try:
             if model_id is None or len(model_id) < 1: return "Invalid model_id", 400
@@ -908,37 +1125,85 @@ class BulkAddModelData(Resource):
             parameters.model_id(True, False, "path"),
             parameters.model(
                 "The model of the columns the data should be sent to, if none is given 'bulk_add' will be used"),
+            parameters.background(),
+            parameters.wait_for_visibility(),
             parameters.body(True, "The jsonlines which contain the data to add")
         ],
-        responseMessages=responses.standard_put()
+        responseMessages=responses.standard_put() + [{"code": 202, "message": "Accepted, added in the background"}]
     )
     def post(self, model_id):
         """
         Add data to the semantic types
         Adds data from jsonlines into the semantic types.  Each line of the body should be a full json file,
         with everything specified in the model.json.  This is the same as using POST /semantic_types/{type_id} to add
-        data to columns, but faster for large amounts of data.
+        data to columns, but faster for large amounts of data.  If background is true the data is added by a
+        background job instead of while the request is open, the returned body is the job in the format of
+        GET /jobs/{job_id}.  If a line isn't a json object the lines before it are still added and a 400 gives the
+        number of the line and how many rows were added.
         """
         try:
             if model_id is None or len(model_id) < 1: return "Invalid model_id", 400
-            if request.data is None or len(request.data) < 1: return "Invalid message body", 400
+            # The body is parsed a line at a time as it is read, so don't touch request.data here
+            if request.content_length == 0: return "Invalid message body", 400
             args = request.args.copy()
             column_model = args.pop(MODEL, None)
+            background = args.pop(BACKGROUND, None)
+            wait_for_visibility = args.pop(WAIT_FOR_VISIBILITY, None)
             if len(args) > 0: return "The following query parameters are invalid:  " + str(args.keys()), 400
             if column_model is None: column_model = DEFAULT_BULK_MODEL
-            data = []
-            for line in request.data.split("\n"):
-                if line.strip() != "":
-                    data.append(json.loads(line))
-            return service.bulk_add_model_data_post(model_id, column_model, data)
+            wait_for_visibility = wait_for_visibility is not None and wait_for_visibility.lower() == "true"
+            if background is not None and background.lower() == "true":
+                return service.bulk_add_model_data_job_post(model_id, column_model, request.stream,
+                                                            wait_for_visibility)
+            return service.bulk_add_model_data_post(model_id, column_model, json_lines(request.stream), None,
+                                                    wait_for_visibility)
+        except:
+            return str(traceback.format_exc()), 500
+
+
+class Jobs(Resource):
+    @swagger.operation(
+        parameters=[
+            parameters.job_id()
+        ],
+        responseMessages=responses.standard_get()
+    )
+    def get(self, job_id):
+        """
+        Get the status of a background job
+        Returns the state and progress of a job, such as a background POST /bulk_add_models/{model_id}.  The state is
+        one of queued, running, done or failed.  Only the most recent jobs are remembered.  Returned body will have the
+        following format:
+        <pre>
+        {
+            "id": "",
+            "kind": "",
+            "state": "",
+            "rowsProcessed": ,
+            "columnsWritten": ,
+            "seconds": ,
+            "rowsPerSecond": ,
+            "result": "",
+            "errors": []
+        }
+        </pre>
+        """
+        try:
+            if len(request.args) > 0: return "Invalid arguments, there should be none", 400
+            return service.job_get(job_id)
         except:
             return str(traceback.format_exc()), 500
 
 
+api.add_resource(Metrics, "/metrics")
+api.add_resource(Ready, "/ready")
 api.add_resource(Predict, "/predict")
+api.add_resource(PredictBatch, "/predict/batch")
+api.add_resource(PredictCache, "/predict/cache")
 api.add_resource(SemanticTypes, "/semantic_types")
 api.add_resource(SemanticTypeColumns, "/semantic_types/<string:" + TYPE_ID_PATH + ">")
 api.add_resource(SemanticTypeColumnData, "/semantic_types/type/<string:" + COLUMN_ID_PATH + ">")
 api.add_resource(BulkAddModels, "/bulk_add_models")
 api.add_resource(BulkAddModelData, "/bulk_add_models/<string:" + MODEL_ID_PATH + ">")
-app.run(debug=True, port=5000, use_reloader=False)
+api.add_resource(Jobs, "/jobs/<string:" + JOB_ID_PATH + ">")
+app.run(debug=True, port=5000, use_reloader=False, threaded=True)
@@ -1,12 +1,22 @@
 import base64
 import collections
 import json
+import os
+import random
 
 from flask import Response
 
 ######## General Constants #########
 DATA_MODEL_PATH = "model/lr.pkl"  # File path for the model used by the semantic labeling
-INDEX_NAME = "data"  # The index_name for use when saving attributes
+INDEX_NAME = "data"  # The index_name for use when saving attributes, once service/reindex.py has been run this is an alias of the current versioned index
+INDEX_DOC_TYPE = "columns"  # The elasticsearch document type of the columns
+SEARCH_BACKEND_ELASTICSEARCH = "elasticsearch"  # Search the columns with elasticsearch
+SEARCH_BACKEND_MEMORY = "memory"  # Search the columns with an in-process index, no elasticsearch needed
+LAZY_STARTUP = os.environ.get("LAZY_STARTUP", "false").lower() == "true"  # Load the model and connections in the background after starting
+WARM_UP_DATA = ["warm up"]  # Data predicted once on startup so the first real predict doesn't pay for anything loading
+WARM_UP_RETRY_SECONDS = 1  # Seconds to wait before warming up again after it failed, this doubles after every failure
+WARM_UP_MAX_RETRY_SECONDS = 60  # The longest wait between attempts to warm up
+SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND", SEARCH_BACKEND_ELASTICSEARCH)  # Which search backend to use
 DEFAULT_NAME = "default"  # Just a name for using when there isn't one
 DEFAULT_MODEL = "default"  # Default model name for use when one isn't provided
 DEFAULT_BULK_MODEL = "bulk_add"  # Default model for columns added using bulk add
@@ -14,19 +24,55 @@ NOT_ALLOWED_CHARS = '[\\/*?"<>|\s\t]'  # Characters not allowed by elastic searc
 ID_DIVIDER = "-"  # The divider that is used to separate the different parts of ID's, like class and property
 CONFIDENCE = 0.1  # Semantic types which have a confidence of lower than this number on predict will not be returned
 SAMPLE_SIZE = 1000 #if the size of the training data is MORE than this threshold value, then sample this threshold values randomly
+PREDICT_PROCESSES = int(os.environ.get("PREDICT_PROCESSES", 0))  # Worker processes for predicting, 0 predicts in the server process
+PREDICT_MAX_PENDING = 64  # The most predict tasks that can be sent to the worker processes at once
+SEARCH_THREADS = 8  # The number of threads used to run searches alongside the rest of a predict
+CRUNCH_THREADS = 8  # The number of columns of bulk add models sent to be predicted at once when updating their learned types, they only run on more than one core with PREDICT_PROCESSES
+SIMILAR_TEXT_SIZE = 10  # The number of the most textually similar columns that are considered on predict
+PREDICTION_CACHE_SIZE = 1024  # The most predict results that will be kept in the prediction cache
+PREDICTION_CACHE_TTL = int(os.environ.get("PREDICTION_CACHE_TTL", 60))  # Seconds a predict result is cached for, for the changes other instances of the service make
+SOURCE_CATALOG_TTL = int(os.environ.get("SOURCE_CATALOG_TTL", 60))  # Seconds before the source names and bulk add models are read from the db again, for the changes other instances of the service make
+MIGRATION_BATCH_SIZE = 1000  # The number of documents written at once when migrating the legacy collection
+CHUNK_SIZE = 1000  # The most values of a column stored in one chunk document
+REPLACE_WAIT_ATTEMPTS = 5  # The number of times an append checks for the values reserved by another append before replacing them
+REPLACE_WAIT_SECONDS = 0.05  # Seconds an append waits between those checks
+COLUMN_BATCH_SIZE = 100  # The number of columns whose values are loaded from the db at once
+INDEX_BULK_SIZE = 500  # The most column documents sent to elasticsearch in one bulk request
+REINDEX_THREADS = 4  # The number of bulk requests sent to elasticsearch at once when rebuilding the index
+REINDEX_VERIFY_ATTEMPTS = 3  # The number of times a rebuilt index is caught up with the db before giving up on its count matching
+REINDEX_CLOCK_SKEW = 60  # Seconds the clocks of the services may be off by, columns changed this long before a reindex started are copied again
+INDEX_REFRESH = os.environ.get("INDEX_REFRESH", "false")  # Refresh of elasticsearch writes: "false", "wait_for" (answer once they can be searched) or "true"
+BULK_ADD_FLUSH_SIZE = 10000  # The most values of one node that are held in memory when adding bulk add data
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))  # The number of background jobs, such as bulk add data uploads, run at once
+JOBS_KEPT = 1000  # The most background jobs whose status is remembered
+JOB_SPOOL_SIZE = 16 * 1024 * 1024  # Bytes of a background upload held in memory, anything bigger is spooled to a temporary file
 
 ######## Mongodb Names ########
+DATABASE_NAME = "data"  # The db everything is stored in
+TYPES_COLLECTION = "types"  # Collection of the semantic types
+COLUMNS_COLLECTION = "columns"  # Collection of the semantic types' columns
+MODELS_COLLECTION = "models"  # Collection of the bulk add models
+COLUMN_CHUNKS_COLLECTION = "columnChunks"  # Collection of the values of the columns, split into chunks
+LEGACY_COLLECTION = "service"  # The single collection everything used to be stored in, see service/migrate.py
 ID = "_id"  # ID for any entry in the db
-DATA_TYPE = "dataType"  # Name for the type of data the entry in the db is, should be used with one of the constants here like DATA_TYPE_SEMANTIC_TYPE
+DATA_TYPE = "dataType"  # Name for the type of data the entry in the legacy collection is, should be used with one of the constants here like DATA_TYPE_SEMANTIC_TYPE
 DATA_TYPE_SEMANTIC_TYPE = "type"  # Name for the Semantic Type, should be used with DATA_TYPE
 DATA_TYPE_COLUMN = "column"  # Name for the Semantic Type's column, should be used with DATA_TYPE
 DATA_TYPE_MODEL = "model"  # Name for the karma model that is uploaded, should be used with DATA_TYPE
 TYPE_ID = "typeId"  # A column's semantic type's id
 DATA = "data"  # Name for a column's data in the db
+COLUMN_VALUES = "values"  # Name for the list of values of a column in the db and search index
+COLUMN_ID = "columnId"  # The id of the column a chunk of values belongs to
+CHUNK_NUMBER = "n"  # The position of a chunk among the chunks of its column, starting at 0
+VALUE_COUNT = "valueCount"  # The number of values ever added to a column, it only holds a sample of SAMPLE_SIZE of them
+DATA_VERSION = "dataVersion"  # A new ObjectId every time the values of a column change
 NAME = "name"  # A column's name
 SOURCE = "source"  # A column's source
 DESC = "description"  # Bulk add model description
 BULK_ADD_MODEL_DATA = "bulkAddData"  # The full model that was given to the POST /bulk_add_models
+CRUNCHED_VERSIONS = "crunchedVersions"  # The dataVersion of each of a bulk add model's columns when its learnedSemanticTypes were computed
+CRUNCHED_AT = "crunchedAt"  # When a bulk add model's learnedSemanticTypes were last computed, in seconds since the epoch
+CRUNCH_PENDING = "crunchPending"  # True while a bulk add model's learnedSemanticTypes are waiting to be computed in the background
 
 ######## Bulk Add model.json Constants ########
 BAC_ID = "id"
@@ -54,6 +100,7 @@ TYPE_ID_PATH="type_id"
 TYPE_ID_VALUE_PATH = "type_id"
 TYPE_ID_VALUE_PATHS = "typeIds"
 MODEL_ID_PATH = "model_id"
+JOB_ID_PATH = "job_id"
 
 ######## Query Parameters ########
 CLASS = "class"
@@ -79,9 +126,36 @@ MODEL_DESC = "modelDesc"
 MODEL_IDS = "modelIds"
 MODEL_ID = "modelId"
 DO_NOT_CRUNCH_DATA_NOW = "doNotCrunchDataNow"
+BACKGROUND = "background"
+WAIT_FOR_VISIBILITY = "waitForVisibility"
 
 ######## Other return names ########
 SCORE = "score"
+PREDICTIONS = "predictions"  # The predicted types of one column in a batch predict
+ERROR = "error"  # Why a column in a batch predict could not be predicted
+METRICS_MIMETYPE = "text/plain; version=0.0.4"  # The content type of the prometheus text format
+READY = "ready"
+STARTUP_TIMES = "startupTimes"
+#### Prediction cache stats ####
+CACHE_SIZE = "size"
+CACHE_MAX_SIZE = "maxSize"
+CACHE_HITS = "hits"
+CACHE_MISSES = "misses"
+CACHE_EPOCH = "epoch"
+#### Background jobs ####
+JOB_ID = "id"
+JOB_KIND = "kind"
+JOB_STATE = "state"
+JOB_ROWS = "rowsProcessed"
+JOB_COLUMNS_WRITTEN = "columnsWritten"
+JOB_SECONDS = "seconds"
+JOB_ROWS_PER_SECOND = "rowsPerSecond"
+JOB_RESULT = "result"
+JOB_ERRORS = "errors"
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
 
 
 def json_response(json_body, code):
@@ -96,6 +170,65 @@ def json_response(json_body, code):
                     mimetype="application/json")
 
 
+def clean_values(values):
+    """
+    Lazily strips each value and skips the empty ones.
+
+    :param values: An iterable of the raw data values, such as the lines of a request body
+    :return: A generator of the cleaned values
+    """
+    for value in values:
+        value = value.strip()
+        if value:
+            yield value
+
+
+class JsonLinesError(ValueError):
+    """
+    Raised by json_lines when a line isn't valid json, line_number is its number counting from 1.
+    """
+
+    def __init__(self, line_number, message):
+        ValueError.__init__(self, "Line %d is not valid json: %s" % (line_number, message))
+        self.line_number = line_number
+
+
+def json_lines(lines):
+    """
+    Lazily parses json lines, skipping the empty ones.
+
+    :param lines: An iterable of the lines, such as a request body stream
+    :return: A generator of the parsed lines, which raises a JsonLinesError when it gets to a line that isn't json
+    """
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            raise JsonLinesError(line_number, str(e))
+
+
+def reservoir_sample(values, size):
+    """
+    Returns a uniform random sample of the values without holding more than size of them in memory at once.
+
+    :param values: An iterable of values, this is only iterated through once
+    :param size:   The most values that will be returned
+    :return: A list of at most size values
+    """
+    sample = []
+    for i, value in enumerate(values):
+        if i < size:
+            sample.append(value)
+        else:
+            j = random.randint(0, i)
+            if j < size:
+                sample[j] = value
+    return sample
+
+
 def get_type_id(class_, property_):
     """
     Returns the id of the semantic type with the given class and property.
@@ -132,6 +265,16 @@ def get_column_id(type_id, column_name, source_name, model):
         source_name) + ID_DIVIDER + base64.b64encode(model)
 
 
+def column_projection():
+    """
+    Returns the projection for finding the columns to give to clean_column_output.  The values of the columns are
+    stored separately, so use Storage.with_values to add them when they are going to be shown.
+
+    :return: A projection for pymongo's find
+    """
+    return {COLUMN_NAME: True, SOURCE_NAME: True, MODEL: True}
+
+
 def clean_column_output(column, show_data=True):
     """
     Gives nice, clean, ordered output for a column (in an OrderedDict).
@@ -146,7 +289,7 @@ def clean_column_output(column, show_data=True):
     o[SOURCE] = column[SOURCE_NAME]
     o[MODEL] = column[MODEL]
     if show_data:
-        o[DATA] = column["values"]
+        o[DATA] = column[COLUMN_VALUES]
     return o
 
 
@@ -170,3 +313,14 @@ def get_type_from_column_id(column_id):
     """
     split_type_id = column_id.split(ID_DIVIDER)
     return split_type_id[0] + ID_DIVIDER + split_type_id[1]
+
+
+def get_source_and_model_from_column_id(column_id):
+    """
+    Returns the source name and model from a column id
+
+    :param column_id: Id of the column to get the source name and model out of
+    :return: The column's source name and model in the form (source_name, model)
+    """
+    split_column_id = column_id.split(ID_DIVIDER)
+    return base64.b64decode(split_column_id[3]), base64.b64decode(split_column_id[4])
@@ -0,0 +1,147 @@
+import collections
+import functools
+import hashlib
+import threading
+import time
+
+from service import *
+from service.metrics import prediction_cache_lookups
+
+
+def _to_bytes(value):
+    return value if isinstance(value, bytes) else value.encode("utf-8")
+
+
+class Fingerprint(object):
+    """
+    Builds a hash which identifies a predict request while the data values are streamed through it.
+    """
+
+    def __init__(self):
+        self._hash = hashlib.sha1()
+
+    def consume(self, values):
+        """
+        Adds each value to the hash as it passes through.
+
+        :param values: An iterable of the (already stripped and non-empty) data values to predict
+        :return: A generator of the same values
+        """
+        for value in values:
+            self._hash.update(_to_bytes(value) + b"\n")
+            yield value
+
+    def hexdigest(self, column_name, namespaces=None, source_names=None, models=None):
+        """
+        Returns the hash of the consumed values together with the rest of the request.
+
+        :param column_name:  Name of the column
+        :param namespaces:   List of allowed namespaces
+        :param source_names: List of allowed source names
+        :param models:       List of allowed column models
+        :return: The hex digest of the request
+        """
+        h = self._hash.copy()
+        h.update(json.dumps([column_name, sorted(namespaces) if namespaces is not None else None,
+                             sorted(source_names) if source_names is not None else None,
+                             sorted(models) if models is not None else None]).encode("utf-8"))
+        return h.hexdigest()
+
+
+class PredictionCache(object):
+    """
+    A bounded LRU cache of predict results.
+
+    Every entry is tagged with the corpus epoch it was computed in and anything which changes the semantic types,
+    columns or their data bumps the epoch, so entries from an older epoch are never returned.
+
+    Notes: The epoch is only bumped by the changes made through this process, so when more than one instance of the
+    service shares the db the entries also expire ttl seconds after they were cached, which is how long a predict can
+    miss the changes made through the other instances.
+    """
+
+    def __init__(self, max_size=PREDICTION_CACHE_SIZE, ttl=PREDICTION_CACHE_TTL):
+        """
+        :param max_size: The most results which are kept
+        :param ttl:      Seconds a result is returned for after it was cached, None to keep it until the epoch changes
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the cached result for the key or None if there isn't a current one.
+
+        :param key: The fingerprint of the request
+        :return: The cached result or None
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] != self.epoch or \
+                    (self.ttl is not None and time.time() - entry[2] >= self.ttl):
+                self.misses += 1
+                prediction_cache_lookups.inc(("miss",))
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            prediction_cache_lookups.inc(("hit",))
+            return entry[1]
+
+    def put(self, key, value, epoch):
+        """
+        Caches a result, dropping the least recently used entry if the cache is full.
+
+        :param key:   The fingerprint of the request
+        :param value: The result to cache
+        :param epoch: The epoch which was current when the result started being computed
+        """
+        with self._lock:
+            if epoch != self.epoch or self.max_size < 1:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (epoch, value, time.time())
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        """
+        Bumps the epoch so that every entry currently in the cache is stale.
+        """
+        with self._lock:
+            self.epoch += 1
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Returns the size and hit/miss counts of the cache.
+
+        :return: An OrderedDict of the stats
+        """
+        with self._lock:
+            o = collections.OrderedDict()
+            o[CACHE_SIZE] = len(self._entries)
+            o[CACHE_MAX_SIZE] = self.max_size
+            o[CACHE_HITS] = self.hits
+            o[CACHE_MISSES] = self.misses
+            o[CACHE_EPOCH] = self.epoch
+            return o
+
+
+def invalidates_predictions(method):
+    """
+    Decorator for Server methods which change the corpus, it bumps the prediction cache's epoch once the method is done.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.prediction_cache.invalidate()
+
+    return wrapper
@@ -0,0 +1,156 @@
+import collections
+import threading
+import time
+
+from service import *
+
+
+def count_sources(db, db_body):
+    """
+    Counts the columns in each source which match a query, without loading any of the columns.
+
+    :param db:      The collection the columns are stored in
+    :param db_body: The query for the columns to count
+    :return: A Counter of the number of matching columns in each source
+    """
+    counts = collections.Counter()
+    for group in db.aggregate([{"$match": db_body}, {"$group": {ID: "$" + SOURCE_NAME, "count": {"$sum": 1}}}]):
+        counts[group[ID]] = group["count"]
+    return counts
+
+
+class _ReloadingCatalog(object):
+    """
+    Something kept in memory which is loaded from the db and then kept up to date by whatever changes it.
+
+    Notes: Only the changes made by this process are applied as they happen, so when more than one instance of the
+    service shares the db it is loaded again once it is older than ttl seconds, which is how long the changes made by
+    the other instances can go unseen.
+    """
+
+    def __init__(self, ttl):
+        """
+        :param ttl: Seconds after loading that the catalog is loaded from the db again, None to never reload it
+        """
+        self.ttl = ttl
+        self._db = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def _read(self, db):
+        raise NotImplementedError
+
+    def _replace(self, contents):
+        raise NotImplementedError
+
+    def load(self, db):
+        """
+        Replaces the catalog with what is currently in the db.
+
+        :param db: The collection to load it from, it is kept for reloading the catalog
+        """
+        loaded_at = time.time()
+        contents = self._read(db)
+        with self._lock:
+            self._replace(contents)
+            self._db = db
+            self._loaded_at = loaded_at
+
+    def _reload_if_expired(self):
+        with self._lock:
+            if self._db is None or self.ttl is None or time.time() - self._loaded_at < self.ttl:
+                return
+            # Pushed forward first so only one thread reloads it
+            self._loaded_at = time.time()
+        self.load(self._db)
+
+
+class SourceNameCatalog(_ReloadingCatalog):
+    """
+    Keeps the number of columns in each source in memory so the source names can be found without scanning all of the
+    columns in the db.  It is loaded from the db (data.columns) and then kept up to date by whatever creates or
+    deletes columns, and reloaded every SOURCE_CATALOG_TTL seconds for the columns other instances change.
+    """
+
+    def __init__(self, ttl=SOURCE_CATALOG_TTL):
+        _ReloadingCatalog.__init__(self, ttl)
+        self._counts = collections.Counter()
+
+    def _read(self, db):
+        return count_sources(db, {})
+
+    def _replace(self, contents):
+        self._counts = contents
+
+    def add(self, source_name, count=1):
+        """
+        Records that columns were created in a source.
+
+        :param source_name: Name of the source
+        :param count:       The number of columns created
+        """
+        with self._lock:
+            self._counts[source_name] += count
+
+    def remove(self, source_counts):
+        """
+        Records that columns were deleted.
+
+        :param source_counts: Dictionary of the number of columns deleted from each source
+        """
+        with self._lock:
+            for source_name, count in source_counts.items():
+                self._counts[source_name] -= count
+                if self._counts[source_name] <= 0:
+                    del self._counts[source_name]
+
+    def source_names(self):
+        """
+        Returns the names of all of the sources which have at least one column.
+
+        :return: A list of source names
+        """
+        self._reload_if_expired()
+        with self._lock:
+            return list(self._counts)
+
+
+class BulkAddModelCatalog(_ReloadingCatalog):
+    """
+    Keeps the source name and column model of every bulk add model in memory, so the data added to a column only has
+    to be looked up in the models in the db when the column can belong to one.  It is loaded from the db (data.models)
+    and then kept up to date by whatever adds models, and reloaded every SOURCE_CATALOG_TTL seconds for the models
+    other instances add.  Deleted models are only forgotten on the next reload, which just costs a lookup.
+    """
+
+    def __init__(self, ttl=SOURCE_CATALOG_TTL):
+        _ReloadingCatalog.__init__(self, ttl)
+        self._keys = set()
+
+    def _read(self, db):
+        return set((m[NAME], m.get(MODEL)) for m in db.find({}, projection={NAME: True, MODEL: True}))
+
+    def _replace(self, contents):
+        self._keys = contents
+
+    def add(self, name, model):
+        """
+        Records that a bulk add model was added.
+
+        :param name:  Name of the model, which is the source name of its columns
+        :param model: The column model of its columns
+        """
+        with self._lock:
+            self._keys.add((name, model))
+
+    def may_contain(self, name, model):
+        """
+        Returns False if there is definitely no bulk add model with the name and column model.
+
+        :param name:  Name of the model, which is the source name of its columns
+        :param model: The column model of its columns
+        :return: True if there may be a model with them
+        """
+        self._reload_if_expired()
+        with self._lock:
+            return (name, model) in self._keys
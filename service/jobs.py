@@ -0,0 +1,117 @@
+import collections
+import logging
+import threading
+import time
+import traceback
+import uuid
+from Queue import Queue
+
+from service import *
+
+logger = logging.getLogger(__name__)
+
+
+class Job(object):
+    """
+    A piece of work run in the background, with the progress it has made so far.  The function doing the work updates
+    rows and columns_written as it goes, everything else is set by the JobQueue.
+    """
+
+    def __init__(self, kind):
+        """
+        :param kind: What the job does, such as "bulk_add_model_data"
+        """
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.state = JOB_QUEUED
+        self.rows = 0
+        self.columns_written = set()
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.errors = []
+
+    def to_json(self):
+        """
+        Returns the state and progress of the job, as returned by GET /jobs/{job_id}.
+
+        :return: An OrderedDict of the job
+        """
+        end = self.finished if self.finished is not None else time.time()
+        elapsed = end - self.started if self.started is not None else 0.0
+        o = collections.OrderedDict()
+        o[JOB_ID] = self.id
+        o[JOB_KIND] = self.kind
+        o[JOB_STATE] = self.state
+        o[JOB_ROWS] = self.rows
+        o[JOB_COLUMNS_WRITTEN] = len(self.columns_written)
+        o[JOB_SECONDS] = elapsed
+        o[JOB_ROWS_PER_SECOND] = self.rows / elapsed if elapsed > 0 else None
+        o[JOB_RESULT] = self.result
+        o[JOB_ERRORS] = list(self.errors)
+        return o
+
+
+class JobQueue(object):
+    """
+    Runs jobs on a pool of background threads, one at a time on each thread in the order they were submitted.
+
+    Notes: Jobs are only kept in memory, the most recent JOBS_KEPT of them can be looked up by their id.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, kept=JOBS_KEPT):
+        """
+        :param workers: The number of jobs which can run at the same time
+        :param kept:    The most jobs which are remembered, the oldest ones are forgotten first
+        """
+        self.kept = kept
+        self._jobs = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._queue = Queue()
+        for i in range(workers):
+            worker = threading.Thread(target=self._work, name="job-worker-" + str(i))
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, kind, func):
+        """
+        Queues a job.
+
+        :param kind: What the job does
+        :param func: Function which does the work, it is given the Job to report its progress on and returns a
+                     (message, code) tuple like the Server methods do, a code of 400 or more fails the job
+        :return: The Job
+        """
+        job = Job(kind)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.kept:
+                self._jobs.popitem(last=False)
+        self._queue.put((job, func))
+        return job
+
+    def get(self, job_id):
+        """
+        Returns a job by its id, or None if there isn't one (or it has been forgotten).
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _work(self):
+        while True:
+            job, func = self._queue.get()
+            job.state = JOB_RUNNING
+            job.started = time.time()
+            try:
+                message, code = func(job)
+                job.result = message
+                if code >= 400:
+                    job.errors.append(message)
+                job.state = JOB_FAILED if code >= 400 else JOB_DONE
+            except Exception:
+                logger.exception("Job %s (%s) failed", job.id, job.kind)
+                job.errors.append(traceback.format_exc())
+                job.state = JOB_FAILED
+            finally:
+                job.finished = time.time()
@@ -0,0 +1,216 @@
+import collections
+import math
+import re
+import threading
+
+from service import *
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    """
+    Splits text into lower case word tokens.
+
+    :param text: The text to tokenize
+    :return: A list of the tokens
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def column_text(doc):
+    """
+    Returns the text of all of the values of a column document.
+
+    :param doc: The column document
+    :return: The values joined by spaces
+    """
+    return " ".join(value if isinstance(value, basestring) else str(value) for value in doc.get(COLUMN_VALUES) or [])
+
+
+class _Index(object):
+    """
+    One named index: the column documents plus an inverted index of the term frequencies of their values.
+    """
+
+    def __init__(self):
+        self.docs = {}
+        self.postings = collections.defaultdict(dict)
+        self.doc_terms = {}
+        self._norms = {}
+
+    def add(self, doc_id, doc):
+        self.remove(doc_id)
+        term_counts = collections.Counter(tokenize(column_text(doc)))
+        for term, count in term_counts.items():
+            self.postings[term][doc_id] = count
+        self.doc_terms[doc_id] = term_counts
+        self.docs[doc_id] = doc
+        self._norms.clear()
+
+    def remove(self, doc_id):
+        if doc_id not in self.docs:
+            return
+        for term in self.doc_terms.pop(doc_id):
+            postings = self.postings[term]
+            postings.pop(doc_id, None)
+            if not postings:
+                del self.postings[term]
+        del self.docs[doc_id]
+        self._norms.clear()
+
+    def idf(self, term):
+        # An empty index has no documents to match, so no term carries any weight
+        if not self.docs:
+            return 0.0
+        return math.log(float(len(self.docs)) / (1 + len(self.postings.get(term, ())))) + 1.0
+
+    def norm(self, doc_id):
+        # The idf of every term changes whenever a document is added or removed, so the norms are cached until then
+        if doc_id not in self._norms:
+            self._norms[doc_id] = math.sqrt(sum((count * self.idf(term)) ** 2
+                                                for term, count in self.doc_terms[doc_id].items()))
+        return self._norms[doc_id]
+
+
+def _matches(doc, source_names, type_ids):
+    return doc.get(SOURCE_NAME) in source_names and (type_ids is None or doc.get(TYPE_ID) in type_ids)
+
+
+def _hit(index_name, doc_id, doc, score=None):
+    hit = {"_index": index_name, "_id": doc_id, "_source": doc}
+    if score is not None:
+        hit["_score"] = score
+    return hit
+
+
+class MemoryIndex(object):
+    """
+    An in-process stand in for the elasticsearch indexes, so the service can be run (or benchmarked) without an
+    elasticsearch cluster.  Columns are kept in memory and the similar text search is a TF-IDF cosine similarity over
+    the words in their values.
+    """
+
+    def __init__(self):
+        self.indexes = collections.defaultdict(_Index)
+        self.lock = threading.RLock()
+
+
+class MemoryIndexer(object):
+    """
+    Does the same job as ServiceIndexer, but for a MemoryIndex.
+    """
+    # The index is lost when the service stops, so it has to be built from the db every time it starts
+    persistent = False
+
+    def __init__(self, memory_index):
+        self.memory_index = memory_index
+
+    def index_columns(self, index_name, docs):
+        """
+        Adds or replaces column documents in the index.
+
+        :param index_name: Name of the index
+        :param docs:       Iterable of the column documents, with their values
+        """
+        with self.memory_index.lock:
+            index = self.memory_index.indexes[index_name]
+            for doc in docs:
+                doc = dict(doc)
+                index.add(doc.pop(ID), doc)
+
+    def append_values(self, index_name, appends):
+        """
+        Adds values to column documents which are already in the index.
+
+        :param index_name: Name of the index
+        :param appends:    List of what to add to each column in the form (column_id, values, replacements)
+        """
+        with self.memory_index.lock:
+            index = self.memory_index.indexes[index_name]
+            for column_id, values, replacements in appends:
+                doc = index.docs.get(column_id)
+                if doc is None:
+                    continue
+                doc = dict(doc)
+                doc[COLUMN_VALUES] = list(doc.get(COLUMN_VALUES) or []) + list(values)
+                for i, value in (replacements or {}).items():
+                    if i < len(doc[COLUMN_VALUES]):
+                        doc[COLUMN_VALUES][i] = value
+                index.add(column_id, doc)
+
+    def delete_columns(self, index_name, column_ids):
+        """
+        Removes column documents from the index.
+
+        :param index_name: Name of the index
+        :param column_ids: Iterable of the ids of the columns to remove
+        """
+        with self.memory_index.lock:
+            index = self.memory_index.indexes[index_name]
+            for column_id in column_ids:
+                index.remove(column_id)
+
+    def refresh(self, index_name):
+        """
+        Does nothing, everything written to a MemoryIndex can be searched right away.
+        """
+
+
+class MemorySearcher(object):
+    """
+    Does the same job as ServiceSearcher, but for a MemoryIndex.  The hits are returned in the same format as
+    elasticsearch's so they can be given straight to the semantic labeler.
+    """
+
+    def __init__(self, memory_index):
+        self.memory_index = memory_index
+
+    def search_types_data(self, index_name, source_names, type_ids=None):
+        """
+        Returns all of the candidate columns in the given sources.
+
+        :param index_name:   Name of the index to search
+        :param source_names: List of the source names the columns must be in
+        :param type_ids:     Collection of the semantic type ids the columns must be in, None if every type is allowed
+        :return: A list of the matching hits
+        """
+        source_names = set(source_names)
+        type_ids = set(type_ids) if type_ids is not None else None
+        with self.memory_index.lock:
+            index = self.memory_index.indexes[index_name]
+            return [_hit(index_name, doc_id, doc) for doc_id, doc in index.docs.items()
+                    if _matches(doc, source_names, type_ids)]
+
+    def search_similar_text_data(self, index_name, text, source_names, type_ids=None):
+        """
+        Returns the candidate columns in the given sources whose values are the most similar to the text.
+
+        :param index_name:   Name of the index to search
+        :param text:         The text of the values being predicted
+        :param source_names: List of the source names the columns must be in
+        :param type_ids:     Collection of the semantic type ids the columns must be in, None if every type is allowed
+        :return: A response in the same format as elasticsearch's
+        """
+        source_names = set(source_names)
+        type_ids = set(type_ids) if type_ids is not None else None
+        query_counts = collections.Counter(tokenize(text))
+        with self.memory_index.lock:
+            index = self.memory_index.indexes[index_name]
+            query_weights = dict((term, count * index.idf(term)) for term, count in query_counts.items())
+            query_norm = math.sqrt(sum(w * w for w in query_weights.values()))
+            dot_products = collections.defaultdict(float)
+            for term, query_weight in query_weights.items():
+                idf = index.idf(term)
+                for doc_id, count in index.postings.get(term, {}).items():
+                    dot_products[doc_id] += query_weight * count * idf
+            scored = []
+            for doc_id, dot_product in dot_products.items():
+                doc = index.docs[doc_id]
+                if not _matches(doc, source_names, type_ids):
+                    continue
+                scored.append((dot_product / (query_norm * index.norm(doc_id)), doc_id))
+            scored.sort(reverse=True)
+            hits = [_hit(index_name, doc_id, index.docs[doc_id], score)
+                    for score, doc_id in scored[:SIMILAR_TEXT_SIZE]]
+        return {"hits": {"total": len(scored), "max_score": hits[0]["_score"] if hits else None, "hits": hits}}
@@ -0,0 +1,278 @@
+import collections
+import functools
+import threading
+import time
+
+from service import *
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if value != float("inf") else "+Inf"
+
+
+class _Metric(object):
+    metric_type = None
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s %s" % (self.name, self.metric_type)]
+        with self._lock:
+            for label_values in sorted(self._values):
+                lines.extend(self._render_value(label_values, self._values[label_values]))
+        return lines
+
+
+class Counter(_Metric):
+    """
+    A count which only goes up, such as the number of requests.
+    """
+    metric_type = "counter"
+
+    def inc(self, label_values=(), amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def _render_value(self, label_values, value):
+        return ["%s%s %s" % (self.name, _format_labels(self.label_names, label_values), _format_value(value))]
+
+
+class Gauge(_Metric):
+    """
+    A value which can go up and down, such as the size of a cache.
+    """
+    metric_type = "gauge"
+
+    def set(self, value, label_values=()):
+        with self._lock:
+            self._values[label_values] = value
+
+    def _render_value(self, label_values, value):
+        return ["%s%s %s" % (self.name, _format_labels(self.label_names, label_values), _format_value(value))]
+
+
+class Histogram(_Metric):
+    """
+    The distribution of durations (in seconds), counted in cumulative buckets.
+    """
+    metric_type = "histogram"
+
+    def __init__(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        _Metric.__init__(self, name, description, label_names)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, label_values=()):
+        with self._lock:
+            counts, total = self._values.get(label_values, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[label_values] = (counts, total + value)
+
+    def _render_value(self, label_values, value):
+        counts, total = value
+        lines = ["%s_bucket%s %d" % (self.name, _format_labels(self.label_names, label_values,
+                                                               ("le", _format_value(bound))), count)
+                 for bound, count in zip(self.buckets, counts)]
+        lines.append("%s_sum%s %s" % (self.name, _format_labels(self.label_names, label_values), _format_value(total)))
+        lines.append("%s_count%s %d" % (self.name, _format_labels(self.label_names, label_values), counts[-1]))
+        return lines
+
+
+class Registry(object):
+    """
+    All of the metrics which are exported by GET /metrics.
+    """
+
+    def __init__(self):
+        self._metrics = collections.OrderedDict()
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """
+        Returns all of the metrics in the prometheus text format.
+
+        :return: The text of the metrics
+        """
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+http_requests = registry.register(Counter(
+    "semantic_labeling_http_requests_total", "Number of HTTP requests by resource, method and status code",
+    ("resource", "method", "code")))
+http_request_duration = registry.register(Histogram(
+    "semantic_labeling_http_request_duration_seconds", "Time taken to answer HTTP requests", ("resource", "method")))
+predict_stage_duration = registry.register(Histogram(
+    "semantic_labeling_predict_stage_duration_seconds", "Time taken by each stage of predicting a column", ("stage",)))
+mongo_operations = registry.register(Counter(
+    "semantic_labeling_mongo_operations_total", "Number of MongoDB operations by Server method and operation",
+    ("method", "operation")))
+mongo_operation_duration = registry.register(Histogram(
+    "semantic_labeling_mongo_operation_duration_seconds", "Time taken by MongoDB operations",
+    ("method", "operation")))
+prediction_cache_entries = registry.register(Gauge(
+    "semantic_labeling_prediction_cache_entries", "Number of results in the prediction cache"))
+prediction_cache_lookups = registry.register(Counter(
+    "semantic_labeling_prediction_cache_lookups_total", "Number of prediction cache lookups by result", ("result",)))
+
+_current = threading.local()
+
+
+def current_method():
+    """
+    Returns the name of the Server method running on this thread, for labeling the MongoDB metrics.
+    """
+    stack = getattr(_current, "methods", None)
+    return stack[-1] if stack else "other"
+
+
+def _call_as(method_name, func, args, kwargs):
+    stack = getattr(_current, "methods", None)
+    if stack is None:
+        stack = _current.methods = []
+    stack.append(method_name)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        stack.pop()
+
+
+def server_method(method):
+    """
+    Decorator for Server methods, the MongoDB operations done while the method is running are labeled with its name.
+    """
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        return _call_as(method.__name__, method, args, kwargs)
+
+    return wrapper
+
+
+def in_current_method(func):
+    """
+    Wraps a function which is about to be run on another thread, such as by a thread pool, so the MongoDB operations
+    it does are labeled with the Server method running on this thread instead of "other".
+    """
+    method_name = current_method()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return _call_as(method_name, func, args, kwargs)
+
+    return wrapper
+
+
+class timed_stage(object):
+    """
+    Context manager which records how long a stage of a predict took.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        record_stage(self.stage, time.time() - self.start)
+
+
+def record_stage(stage, duration):
+    predict_stage_duration.observe(duration, (stage,))
+
+
+def record_mongo_operation(operation, duration):
+    labels = (current_method(), operation)
+    mongo_operations.inc(labels)
+    mongo_operation_duration.observe(duration, labels)
+
+
+class _TimedCursor(object):
+    """
+    Wraps a pymongo cursor so the time spent fetching its documents is recorded once it is exhausted.
+    """
+
+    def __init__(self, cursor, method):
+        self._cursor = cursor
+        self._method = method
+        self._elapsed = 0.0
+        self._recorded = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = time.time()
+        try:
+            doc = next(self._cursor)
+        except StopIteration:
+            self._record(time.time() - start)
+            raise
+        self._elapsed += time.time() - start
+        return doc
+
+    __next__ = next
+
+    def _record(self, elapsed):
+        if not self._recorded:
+            self._recorded = True
+            labels = (self._method, "find")
+            mongo_operations.inc(labels)
+            mongo_operation_duration.observe(self._elapsed + elapsed, labels)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class InstrumentedCollection(object):
+    """
+    Wraps a pymongo collection so that the number and duration of the operations done on it are recorded.
+    """
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def find(self, *args, **kwargs):
+        # A cursor doesn't talk to the db until it is iterated, so that is what gets timed
+        return _TimedCursor(self._collection.find(*args, **kwargs), current_method())
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if not callable(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                record_mongo_operation(name, time.time() - start)
+
+        return timed
@@ -0,0 +1,48 @@
+"""
+Moves everything out of the single collection the service used to store everything in (data.service) into the
+collections for each kind of document (data.types, data.columns and data.models), moves the values of the columns
+into chunks (data.columnChunks), creates the indexes and indexes every column into the search backend.
+
+Usage:
+    python -m service.migrate
+    python -m service.migrate --drop-legacy
+"""
+import argparse
+import logging
+
+from pymongo import MongoClient
+
+from service import *
+from service.search import create_search_backend
+from service.storage import Storage
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Migrate the semantic labeling service's db to one collection per kind")
+    parser.add_argument("--host", default="localhost", help="Host of the MongoDB")
+    parser.add_argument("--port", type=int, default=27017, help="Port of the MongoDB")
+    parser.add_argument("--drop-legacy", action="store_true",
+                        help="Drop the legacy collection once everything has been copied out of it")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    storage = Storage(MongoClient(args.host, args.port))
+    counts = storage.migrate_legacy()
+    for name in sorted(counts):
+        print("Copied %d documents into %s.%s" % (counts[name], DATABASE_NAME, name))
+    storage.ensure_indexes()
+    print("Created the indexes")
+    print("Moved the values of %d columns into chunks" % storage.chunk_inline_values())
+    indexer = create_search_backend()[0]
+    if indexer.persistent:
+        # Created with the mappings first, otherwise the first write would create it with dynamic ones
+        indexer.ensure_index(INDEX_NAME)
+        indexer.index_columns(INDEX_NAME, storage.with_values(storage.columns.find({})))
+        print("Indexed every column")
+    if args.drop_legacy:
+        storage.database.drop_collection(LEGACY_COLLECTION)
+        print("Dropped %s.%s" % (DATABASE_NAME, LEGACY_COLLECTION))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Rebuilds the elasticsearch index of the columns from MongoDB without predicts ever seeing a partial index.
+
+The columns are loaded into a new versioned index (data_v{timestamp}) with parallel bulk requests while the service
+keeps using the old one.  The columns written while that runs are then copied over, the number of documents is
+checked against MongoDB and the alias the service uses (INDEX_NAME) is moved to the new index in one atomic step.
+If INDEX_NAME is still a plain index, as it is before the first reindex, it is replaced by the alias in that same
+step.  Nothing is switched if the counts don't match.
+
+Usage:
+    python -m service.reindex
+    python -m service.reindex --threads 8 --keep-old
+"""
+import argparse
+import datetime
+import logging
+import sys
+import time
+
+from bson import ObjectId
+from elasticsearch.helpers import scan
+from pymongo import MongoClient
+
+from service import *
+from service.search import create_search_backend, index_body
+from service.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+def _catch_up(storage, indexer, index_name, since):
+    """
+    Copies the columns whose data changed since a time into the index and removes the ones which no longer exist.
+
+    :param storage:    The Storage
+    :param indexer:    The ServiceIndexer
+    :param index_name: Name of the index to update
+    :param since:      The UTC datetime to copy the changes since
+    :return: The number of columns copied and the number removed in the form (copied, removed)
+    """
+    changed = list(storage.columns.find({DATA_VERSION: {"$gte": ObjectId.from_datetime(since)}}))
+    indexer.index_columns(index_name, storage.with_values(changed))
+    column_ids = set(column[ID] for column in storage.columns.find({}, projection={ID: True}))
+    removed = [hit["_id"] for hit in scan(indexer.es, index=index_name, query={"query": {"match_all": {}}},
+                                          _source=False) if hit["_id"] not in column_ids]
+    indexer.delete_columns(index_name, removed)
+    return len(changed), len(removed)
+
+
+def _swap_alias(es, alias, index_name):
+    """
+    Atomically points the alias at the index, replacing whatever the alias (or an index with its name) was before.
+
+    :param es:         The elasticsearch client
+    :param alias:      Name of the alias
+    :param index_name: Name of the index to point it at
+    :return: List of the names of the indexes the alias was pointing at before
+    """
+    actions = [{"add": {"index": index_name, "alias": alias}}]
+    old_indexes = []
+    if es.indices.exists_alias(name=alias):
+        old_indexes = [name for name in es.indices.get_alias(name=alias) if name != index_name]
+        actions.extend({"remove": {"index": name, "alias": alias}} for name in old_indexes)
+    elif es.indices.exists(index=alias):
+        # The index the service wrote to before there were versioned indexes, it is dropped in the same step
+        actions.append({"remove_index": {"index": alias}})
+    es.indices.update_aliases(body={"actions": actions})
+    return old_indexes
+
+
+def reindex(storage, indexer, alias=INDEX_NAME, threads=REINDEX_THREADS, keep_old=False):
+    """
+    Builds a new versioned index of every column and switches the alias to it.
+
+    :param storage:  The Storage
+    :param indexer:  The ServiceIndexer
+    :param alias:    Name of the alias the service searches
+    :param threads:  The number of bulk requests sent at once while loading the new index
+    :param keep_old: True if the indexes the alias pointed at before should be kept instead of deleted
+    :return: The name of the new index, or None if its document count didn't match MongoDB and nothing was switched
+    """
+    es = indexer.es
+    index_name = "%s_v%d" % (alias, int(time.time()))
+    # Anything written from here on is in the old index but may not have been read into the new one
+    started = datetime.datetime.utcnow() - datetime.timedelta(seconds=REINDEX_CLOCK_SKEW)
+    es.indices.create(index=index_name, body=index_body(refresh_interval="-1"))
+    start = time.time()
+    indexer.index_columns_parallel(index_name, storage.with_values(storage.columns.find({})), threads)
+    es.indices.put_settings(index=index_name, body={"index": {"refresh_interval": None}})
+    logger.info("Loaded %s in %.1f seconds", index_name, time.time() - start)
+
+    for _ in range(REINDEX_VERIFY_ATTEMPTS):
+        caught_up = datetime.datetime.utcnow() - datetime.timedelta(seconds=REINDEX_CLOCK_SKEW)
+        copied, removed = _catch_up(storage, indexer, index_name, started)
+        es.indices.refresh(index=index_name)
+        expected = storage.columns.count_documents({})
+        indexed = es.count(index=index_name)["count"]
+        logger.info("Caught up %s with %d changed and %d removed columns, it has %d of %d columns",
+                    index_name, copied, removed, indexed, expected)
+        if indexed == expected:
+            break
+        started = caught_up
+    else:
+        logger.error("%s doesn't have the same number of columns as the db, it was deleted and %s wasn't switched",
+                     index_name, alias)
+        es.indices.delete(index=index_name)
+        return None
+
+    old_indexes = _swap_alias(es, alias, index_name)
+    # Writes which reached the old index between catching up and switching are copied over too
+    _catch_up(storage, indexer, index_name, caught_up)
+    logger.info("Switched %s to %s", alias, index_name)
+    if not keep_old:
+        for name in old_indexes:
+            es.indices.delete(index=name)
+            logger.info("Deleted %s", name)
+    return index_name
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild the semantic labeling service's search index from the db")
+    parser.add_argument("--host", default="localhost", help="Host of the MongoDB")
+    parser.add_argument("--port", type=int, default=27017, help="Port of the MongoDB")
+    parser.add_argument("--threads", type=int, default=REINDEX_THREADS,
+                        help="Number of bulk requests sent to elasticsearch at once")
+    parser.add_argument("--keep-old", action="store_true", help="Keep the old index instead of deleting it")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    indexer = create_search_backend()[0]
+    if not indexer.persistent:
+        print("The %s search backend is built from the db when the service starts, there is nothing to reindex"
+              % SEARCH_BACKEND)
+        return
+    index_name = reindex(Storage(MongoClient(args.host, args.port)), indexer, INDEX_NAME, args.threads,
+                         args.keep_old)
+    if index_name is None:
+        sys.exit(1)
+    print("%s now points to %s" % (INDEX_NAME, index_name))
+
+
+if __name__ == "__main__":
+    main()
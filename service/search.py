@@ -0,0 +1,211 @@
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import BulkIndexError, bulk, parallel_bulk, scan
+from semantic_labeling.search.indexer import Indexer
+from semantic_labeling.search.searcher import Searcher
+
+from service import *
+from service.memory_search import MemoryIndex, MemoryIndexer, MemorySearcher
+
+# Painless script which adds the values in its params to the end of a column document and then replaces the values at
+# the positions in its replacements
+APPEND_SCRIPT = ("if (ctx._source.%(values)s == null) { ctx._source.%(values)s = [] } "
+                 "ctx._source.%(values)s.addAll(params.values); "
+                 "for (entry in params.replacements.entrySet()) { int i = Integer.parseInt(entry.getKey()); "
+                 "if (i < ctx._source.%(values)s.size()) { ctx._source.%(values)s[i] = entry.getValue() } }"
+                 ) % {"values": COLUMN_VALUES}
+# How many times an append is retried when the column document is changed by something else while it is running
+APPEND_RETRIES = 5
+# Mappings of the column documents, the fields the searches filter on are keywords so they are only matched exactly (a
+# string which is mapped dynamically is analyzed text, which the terms filters never match)
+INDEX_MAPPINGS = {INDEX_DOC_TYPE: {"properties": {
+    TYPE_ID: {"type": "keyword"},
+    COLUMN_NAME: {"type": "keyword"},
+    SOURCE_NAME: {"type": "keyword"},
+    MODEL: {"type": "keyword"},
+    COLUMN_VALUES: {"type": "text"}
+}}}
+
+
+def index_body(**settings):
+    """
+    Returns the body to create an index of the columns with, every index of the columns is created from this.
+
+    :param settings: Index settings to create it with, such as refresh_interval
+    :return: The body of the create index request
+    """
+    return {"settings": settings, "mappings": INDEX_MAPPINGS}
+
+
+def _index_source(doc):
+    """
+    Returns what is stored in the index for a column document, which is everything but its id and dataVersion (an
+    ObjectId, which isn't searched and can't be sent as json).
+    """
+    return dict((k, v) for k, v in doc.items() if k not in (ID, DATA_VERSION))
+
+
+def _column_filters(source_names, type_ids=None):
+    """
+    Returns the filters a candidate column has to match to be used in a prediction.
+
+    :param source_names: List of the source names the columns must be in
+    :param type_ids:     Collection of the semantic type ids the columns must be in, None if every type is allowed
+    :return: A list of elasticsearch filters
+    """
+    filters = [{"terms": {SOURCE_NAME: list(source_names)}}]
+    if type_ids is not None:
+        filters.append({"terms": {TYPE_ID: list(type_ids)}})
+    return filters
+
+
+class ServiceIndexer(Indexer):
+    """
+    Indexer for the elasticsearch backend.  The service indexes the columns itself whenever it writes them, since
+    their values are stored in chunks which have to be put back together before they can be searched.
+
+    Notes: Everything is sent in bulk requests of at most INDEX_BULK_SIZE documents, with the refresh given to the
+    constructor.  Writes made with refresh "false" can be searched after elasticsearch's next refresh (about a
+    second), use refresh to make them searchable right away.
+    """
+    # Elasticsearch keeps its indexes, so they don't have to be rebuilt from the db when the service starts
+    persistent = True
+
+    def __init__(self, es, refresh_mode=INDEX_REFRESH):
+        """
+        :param es:           The elasticsearch client
+        :param refresh_mode: The refresh of every write: "false", "wait_for" or "true"
+        """
+        Indexer.__init__(self, es)
+        self.es = es
+        self.refresh_mode = refresh_mode
+
+    def _bulk(self, actions, **kwargs):
+        return bulk(self.es, actions, chunk_size=INDEX_BULK_SIZE, refresh=self.refresh_mode, **kwargs)
+
+    def index_columns(self, index_name, docs):
+        """
+        Adds or replaces column documents in the index.
+
+        :param index_name: Name of the index
+        :param docs:       Iterable of the column documents, with their values, this is only iterated through once
+        """
+        self._bulk(self._index_actions(index_name, docs))
+
+    def index_columns_parallel(self, index_name, docs, threads):
+        """
+        Adds or replaces column documents in the index, sending many bulk requests at once.  This is for loading a
+        whole index, such as when rebuilding it, so the refresh mode isn't used.
+
+        :param index_name: Name of the index
+        :param docs:       Iterable of the column documents, with their values, this is only iterated through once
+        :param threads:    The number of bulk requests sent at once
+        """
+        for _ in parallel_bulk(self.es, self._index_actions(index_name, docs), thread_count=threads,
+                               chunk_size=INDEX_BULK_SIZE):
+            pass
+
+    @staticmethod
+    def _index_actions(index_name, docs):
+        for doc in docs:
+            yield {"_index": index_name, "_type": INDEX_DOC_TYPE, "_id": doc[ID], "_source": _index_source(doc)}
+
+    def append_values(self, index_name, appends):
+        """
+        Adds values to column documents which are already in the index, without sending their other values.
+
+        :param index_name: Name of the index
+        :param appends:    List of what to add to each column in the form (column_id, values, replacements), where
+                           values are added to the end of the column and replacements is a dictionary of the positions
+                           of values to replace to their new values
+        """
+        self._bulk({"_op_type": "update", "_index": index_name, "_type": INDEX_DOC_TYPE, "_id": column_id,
+                    "retry_on_conflict": APPEND_RETRIES,
+                    "script": {"source": APPEND_SCRIPT, "lang": "painless",
+                               "params": {"values": values, "replacements": dict(
+                                   (str(i), value) for i, value in (replacements or {}).items())}}}
+                   for column_id, values, replacements in appends)
+
+    def delete_columns(self, index_name, column_ids):
+        """
+        Removes column documents from the index, any which aren't in it are ignored.
+
+        :param index_name: Name of the index
+        :param column_ids: Iterable of the ids of the columns to remove
+        """
+        actions = ({"_op_type": "delete", "_index": index_name, "_type": INDEX_DOC_TYPE, "_id": column_id}
+                   for column_id in column_ids)
+        _, errors = self._bulk(actions, raise_on_error=False)
+        errors = [error for error in errors if error.get("delete", {}).get("status") != 404]
+        if errors:
+            raise BulkIndexError("%d column document(s) failed to be removed" % len(errors), errors)
+
+    def ensure_index(self, index_name):
+        """
+        Creates the index with the mappings of the columns if there is no index or alias with its name yet.
+
+        :param index_name: Name of the index
+        """
+        if not self.es.indices.exists(index=index_name):
+            # Ignores the index having been created by another instance of the service since the check
+            self.es.indices.create(index=index_name, body=index_body(), ignore=400)
+
+    def refresh(self, index_name):
+        """
+        Makes everything written to the index so far searchable.
+
+        :param index_name: Name of the index
+        """
+        self.es.indices.refresh(index=index_name)
+
+
+class ServiceSearcher(Searcher):
+    """
+    Searcher which can restrict the candidate columns to the semantic types that a predict is allowed to return, so
+    the columns of every other semantic type are never retrieved from elasticsearch or scored.
+    """
+
+    def __init__(self, es):
+        Searcher.__init__(self, es)
+        self.es = es
+
+    def search_types_data(self, index_name, source_names, type_ids=None):
+        """
+        Returns all of the candidate columns in the given sources.
+
+        :param index_name:   Name of the index to search
+        :param source_names: List of the source names the columns must be in
+        :param type_ids:     Collection of the semantic type ids the columns must be in, None if every type is allowed
+        :return: A list of the matching hits
+        """
+        return list(scan(self.es, index=index_name,
+                         query={"query": {"bool": {"filter": _column_filters(source_names, type_ids)}}}))
+
+    def search_similar_text_data(self, index_name, text, source_names, type_ids=None):
+        """
+        Returns the candidate columns in the given sources whose values are the most similar to the text.
+
+        :param index_name:   Name of the index to search
+        :param text:         The text of the values being predicted
+        :param source_names: List of the source names the columns must be in
+        :param type_ids:     Collection of the semantic type ids the columns must be in, None if every type is allowed
+        :return: The elasticsearch response
+        """
+        return self.es.search(index=index_name, size=SIMILAR_TEXT_SIZE, body={
+            "query": {"bool": {"must": {"match": {COLUMN_VALUES: text}},
+                               "filter": _column_filters(source_names, type_ids)}}})
+
+
+def create_search_backend(backend=SEARCH_BACKEND):
+    """
+    Creates the indexer and searcher for the chosen search backend.
+
+    :param backend: SEARCH_BACKEND_ELASTICSEARCH or SEARCH_BACKEND_MEMORY
+    :return: The indexer and searcher in the form (indexer, searcher)
+    """
+    if backend == SEARCH_BACKEND_MEMORY:
+        memory_index = MemoryIndex()
+        return MemoryIndexer(memory_index), MemorySearcher(memory_index)
+    if backend == SEARCH_BACKEND_ELASTICSEARCH:
+        elastic_search = Elasticsearch()
+        return ServiceIndexer(elastic_search), ServiceSearcher(elastic_search)
+    raise ValueError("Unknown search backend: " + str(backend))
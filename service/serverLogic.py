@@ -1,27 +1,276 @@
+import logging
+import shutil
+import tempfile
+import threading
+import time
 import validators
-from elasticsearch import Elasticsearch
-from pymongo import MongoClient
+from multiprocessing.pool import ThreadPool
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import DuplicateKeyError
 import random
+from bson import ObjectId
 from semantic_labeling.lib.column import Column
 from semantic_labeling.lib.source import Source
 from semantic_labeling.main.random_forest import MyRandomForest
-from semantic_labeling.search.indexer import Indexer
-from semantic_labeling.search.searcher import Searcher
 
 from service import *
+from service.cache import Fingerprint, PredictionCache, invalidates_predictions
+from service.catalog import BulkAddModelCatalog, SourceNameCatalog
+from service.jobs import JobQueue
+from service.metrics import in_current_method, prediction_cache_entries, record_stage, registry, server_method, \
+    timed_stage
+from service.search import create_search_backend
+from service.storage import Storage
+from service.workers import PredictionPool, predict_column, prepare_column
+
+logger = logging.getLogger(__name__)
+search_pool = ThreadPool(SEARCH_THREADS)
+crunch_pool = ThreadPool(CRUNCH_THREADS)
+
+
+def _insert_only(doc):
+    """
+    Returns a bulk write operation which inserts the document, unless there already is one with the same id.
+    """
+    return UpdateOne({ID: doc[ID]}, {"$setOnInsert": dict((k, v) for k, v in doc.items() if k != ID)}, upsert=True)
+
+
+def _search_types_data(searcher, source_names, allowed_ids):
+    with timed_stage("types_search"):
+        return searcher.search_types_data(INDEX_NAME, source_names, allowed_ids)
 
-elastic_search = Elasticsearch()
-indexer = Indexer(elastic_search)
-searcher = Searcher(elastic_search)
 
 class Server(object):
-    def __init__(self):
-        self.db = MongoClient().data.service
-        self.classifier = MyRandomForest({}, {}, DATA_MODEL_PATH)
-        self.classifier.train([])
+    def __init__(self, lazy_startup=LAZY_STARTUP, mongo_client=None):
+        """
+        :param lazy_startup: True if the model, search backend and source catalog should be loaded in the background after this returns, otherwise they are all loaded before it returns
+        :param mongo_client: The (optional) client to use instead of connecting to the local MongoDB, such as a stand in for benchmarking
+        """
+        # Nothing here talks to the db, the connection is made the first time it is used
+        if mongo_client is None:
+            mongo_client = MongoClient(connect=False)
+        self.storage = Storage(mongo_client)
+        self.types = self.storage.types
+        self.columns = self.storage.columns
+        self.models = self.storage.models
+        # Columns are predicted in worker processes if there are any, the workers search with their own connections so
+        # they can't be used with the memory backend, whose index only exists in this process
+        self.prediction_pool = PredictionPool() \
+            if PREDICT_PROCESSES > 0 and SEARCH_BACKEND != SEARCH_BACKEND_MEMORY else None
+        self.prediction_cache = PredictionCache()
+        self.jobs = JobQueue()
+        self._crunch_lock = threading.Lock()
+        self._crunch_queued = set()
+        self.ready = False
+        self.startup_times = collections.OrderedDict()
+        self._startup_lock = threading.RLock()
+        self._classifier = None
+        self._source_catalog = None
+        self._bulk_add_model_catalog = None
+        self._search_backend = None
+        # Without lazy startup the first attempt is made before the server starts, if it fails it is retried in the
+        # background the same as with lazy startup, so the server becomes ready once whatever was down is back
+        if lazy_startup or not self._warm_up():
+            warm_up = threading.Thread(target=self._keep_warming_up, name="warm-up",
+                                       args=(0 if lazy_startup else WARM_UP_RETRY_SECONDS,))
+            warm_up.daemon = True
+            warm_up.start()
+        compaction = threading.Thread(target=self._compact_columns, name="compaction")
+        compaction.daemon = True
+        compaction.start()
+
+    ################ Startup ################
+
+    def _load_once(self, attribute, phase, loader):
+        """
+        Returns the value of an attribute, loading it first if this is the first time it has been asked for.
+
+        :param attribute: Name of the attribute which holds the value, it is None until the value is loaded
+        :param phase:     Name of the startup phase for the startup times and log
+        :param loader:    Function which loads and returns the value
+        :return: The value of the attribute
+        """
+        value = getattr(self, attribute)
+        if value is None:
+            with self._startup_lock:
+                value = getattr(self, attribute)
+                if value is None:
+                    value = self._timed_phase(phase, loader)
+                    setattr(self, attribute, value)
+        return value
+
+    def _timed_phase(self, phase, func):
+        start = time.time()
+        result = func()
+        self.startup_times[phase] = time.time() - start
+        logger.info("Startup phase '%s' took %.3f seconds", phase, self.startup_times[phase])
+        return result
+
+    def _load_classifier(self):
+        classifier = MyRandomForest({}, {}, DATA_MODEL_PATH)
+        classifier.train([])
+        return classifier
+
+    def _load_source_catalog(self):
+        source_catalog = SourceNameCatalog()
+        source_catalog.load(self.columns)
+        return source_catalog
+
+    def _load_bulk_add_model_catalog(self):
+        bulk_add_model_catalog = BulkAddModelCatalog()
+        bulk_add_model_catalog.load(self.models)
+        return bulk_add_model_catalog
+
+    def _load_search_backend(self):
+        indexer, searcher = create_search_backend()
+        if indexer.persistent:
+            indexer.ensure_index(INDEX_NAME)
+        else:
+            indexer.index_columns(INDEX_NAME, self.storage.with_values(self.columns.find({})))
+        return indexer, searcher
+
+    @property
+    def classifier(self):
+        return self._load_once("_classifier", "model", self._load_classifier)
+
+    @property
+    def source_catalog(self):
+        return self._load_once("_source_catalog", "source catalog", self._load_source_catalog)
+
+    @property
+    def bulk_add_model_catalog(self):
+        return self._load_once("_bulk_add_model_catalog", "bulk add model catalog", self._load_bulk_add_model_catalog)
+
+    @property
+    def indexer(self):
+        return self._load_once("_search_backend", "search backend", self._load_search_backend)[0]
+
+    @property
+    def searcher(self):
+        return self._load_once("_search_backend", "search backend", self._load_search_backend)[1]
+
+    def _keep_warming_up(self, delay=0):
+        """
+        Warms up until it succeeds, waiting twice as long after every failed attempt (up to WARM_UP_MAX_RETRY_SECONDS).
+
+        :param delay: Seconds to wait before the first attempt
+        """
+        while True:
+            time.sleep(delay)
+            if self._warm_up():
+                return
+            delay = min(max(delay * 2, WARM_UP_RETRY_SECONDS), WARM_UP_MAX_RETRY_SECONDS)
+
+    @server_method
+    def _warm_up(self):
+        """
+        Loads everything that is loaded lazily and runs one prediction, then marks the server as ready.
+
+        :return: True if it succeeded, otherwise the error is logged and False is returned
+        """
+        start = time.time()
+        try:
+            self._timed_phase("db connection", lambda: self.types.find_one({}, projection={ID: True}))
+            self._timed_phase("db indexes", self.storage.ensure_indexes)
+            self.classifier
+            self.source_catalog
+            self.bulk_add_model_catalog
+            self.searcher
+            source_names = self.source_catalog.source_names()
+            if source_names:
+                self._timed_phase("warm up prediction",
+                                  lambda: self._predict_column(DEFAULT_NAME, source_names[:1], WARM_UP_DATA))
+            else:
+                logger.info("Skipped the warm up prediction since there are no columns yet")
+        except Exception:
+            logger.exception("Warming up failed, it will be retried")
+            return False
+        self.ready = True
+        logger.info("Server ready after %.3f seconds", time.time() - start)
+        return True
+
+    @server_method
+    def metrics_get(self):
+        """
+        Returns the request, predict stage and MongoDB metrics in the prometheus text format.
+
+        :return: A flask Response with the metrics
+        """
+        cache_stats = self.prediction_cache.stats()
+        prediction_cache_entries.set(cache_stats[CACHE_SIZE])
+        return Response(response=registry.render(), status=200, mimetype=METRICS_MIMETYPE)
+
+    @server_method
+    def ready_get(self):
+        """
+        Returns if the server has finished warming up and can answer requests without loading anything first.
+
+        :return: The startup times of each phase with a 200 if it is ready, otherwise a 503
+        """
+        o = collections.OrderedDict()
+        o[READY] = self.ready
+        o[STARTUP_TIMES] = self.startup_times
+        return json_response(o, 200 if self.ready else 503)
+
+    @server_method
+    def _compact_columns(self):
+        """
+        Samples the columns which hold more than SAMPLE_SIZE values, such as the ones created before columns were
+        sampled as values are added to them, down to SAMPLE_SIZE values.
+        """
+        try:
+            column_ids = self.storage.oversized_columns()
+            for column_id in column_ids:
+                values = self.storage.compact_values(column_id)
+                column = self.columns.find_one({ID: column_id})
+                if column is not None:
+                    column[COLUMN_VALUES] = values
+                    self.indexer.index_columns(INDEX_NAME, [column])
+        except Exception:
+            logger.exception("Compacting the columns failed")
+            return
+        if column_ids:
+            self.prediction_cache.invalidate()
+            logger.info("Compacted %d columns down to %d values", len(column_ids), SAMPLE_SIZE)
 
     ################ Stuff for use in this file ################
 
+    @staticmethod
+    def _type_document(class_, property_):
+        """
+        Returns the db document of a semantic type.
+
+        :param class_:    The class of the semantic type
+        :param property_: The property of the semantic type
+        :return: The document, its ID is the id of the semantic type
+        """
+        class_ = class_.rstrip("/")
+        property_ = property_.rstrip("/")
+        namespace = "/".join(class_.replace("#", "/").split("/")[:-1])
+        return {ID: get_type_id(class_, property_), CLASS: class_, PROPERTY: property_, NAMESPACE: namespace}
+
+    @staticmethod
+    def _column_document(column, type_id, column_name, source_name, model):
+        """
+        Returns the db document of a column and the values to store in its chunks.
+
+        :param column:      The Column, with the data which will be added to the column on creation
+        :param type_id:     Id of the semantic type the column belongs to
+        :param column_name: Name of the column
+        :param source_name: Name of the source of the column
+        :param model:       Model of the column
+        :return: The document, its ID is the id of the column, and the list of values in the form (document, values)
+        """
+        db_body = {ID: get_column_id(type_id, column_name, source_name, model), TYPE_ID: type_id,
+                   COLUMN_NAME: column_name, SOURCE_NAME: source_name, MODEL: model}
+        db_body.update(column.to_json())
+        values = db_body.pop(COLUMN_VALUES, None) or []
+        db_body[VALUE_COUNT] = len(values)
+        db_body[DATA_VERSION] = ObjectId()
+        #if the size of the training data is MORE than a threshold value, then sample the threshold values randomly
+        if len(values) > SAMPLE_SIZE: values = random.sample(values, SAMPLE_SIZE)
+        return db_body, values
+
     def _create_column(self, column, type_id, column_name, source_name, model, force=False):
         """
         Create a column in a semantic type and return the column's id if it was created successfully.
@@ -36,66 +285,276 @@ class Server(object):
         :param force:       Force create the column, if this is true and the column exists the old column will be deleted (with all of its data) before creation
         :return: The id of the new column and a response code of 201 if the creation was successful, otherwise it will be an error message with the appropriate error code
         """
-        column_id = get_column_id(type_id, column_name, source_name, model)
-        db_body = {ID: column_id, DATA_TYPE: DATA_TYPE_COLUMN, TYPE_ID: type_id, COLUMN_NAME: column_name,
-                   SOURCE_NAME: source_name, MODEL: model}
-        if self.db.find_one(db_body):
+        db_body, values = self._column_document(column, type_id, column_name, source_name, model)
+        column_id = db_body[ID]
+        if self.columns.find_one({ID: column_id}, projection={ID: True}):
             if force:
-                self.db.delete_many(db_body)
+                self._delete_columns({ID: column_id})
             else:
                 return "Column already exists", 409
-        db_body.update(column.to_json())
-        self.db.insert_one(db_body)
+        self.columns.insert_one(db_body)
+        self.storage.write_values(column_id, values)
+        self.source_catalog.add(source_name)
+        db_body[COLUMN_VALUES] = values
+        self.indexer.index_columns(INDEX_NAME, [db_body])
         return column_id, 201
 
-    def _predict_column(self, column_name, source_names, data):
+    def _append_values(self, appends):
+        """
+        Adds values to columns and updates their search index documents with one bulk request.
+
+        :param appends: List of the ids of the columns and the values to add to them in the form (column_id, values)
+        :return: True if the values were added, False if one of the columns doesn't exist (the values of the columns before it are still added)
+        """
+        index_appends = []
+        found = True
+        for column_id, values in appends:
+            result = self.storage.append_values(column_id, values)
+            if result is None:
+                found = False
+                break
+            appended, replacements = result
+            if appended or replacements:
+                index_appends.append((column_id, appended, replacements))
+        if index_appends:
+            self.indexer.append_values(INDEX_NAME, index_appends)
+        return found
+
+    def _delete_columns(self, db_body):
+        """
+        Deletes all of the columns which match the given query and removes them from the source name catalog.
+
+        :param db_body: The query for the columns to delete
+        :return: The number of columns deleted
+        """
+        columns = list(self.columns.find(db_body, projection={SOURCE_NAME: True}))
+        column_ids = [c[ID] for c in columns]
+        deleted_count = self.columns.delete_many({ID: {"$in": column_ids}}).deleted_count
+        self.storage.delete_values(column_ids)
+        self.source_catalog.remove(collections.Counter(c[SOURCE_NAME] for c in columns))
+        self.indexer.delete_columns(INDEX_NAME, column_ids)
+        return deleted_count
+
+    def _predict_column(self, column_name, source_names, data, types_data=None, allowed_ids=None):
         """
         Predicts the semantic type of a column.
 
         :param column_name:  Name of the column
         :param source_names: List of source names
         :param data:         The data to predict based opon
+        :param types_data:   The (optional) result of searching the types data for the source names, give this when predicting many columns against the same sources so the search is only done once.  It isn't used with worker processes, which search for it themselves
+        :param allowed_ids:  Set of the semantic type ids which may be predicted, None if all of them may be
         :return: A list of dictionaries which each contain the semantic type and confidence score
         """
-        att = Column(column_name, source_names[0])
+        if self.prediction_pool is not None:
+            # The worker does the whole predict, so the data is the only thing pickled and it is one round trip
+            predictions, stage_times = self.prediction_pool.run(predict_column, column_name, source_names, data,
+                                                                allowed_ids)
+            for stage, duration in stage_times:
+                record_stage(stage, duration)
+            return predictions
+
+        # The types search doesn't depend on the data, so it runs while the data is prepared and the text is searched
+        types_search = None
+        if types_data is None:
+            types_search = search_pool.apply_async(in_current_method(_search_types_data),
+                                                   (self.searcher, source_names, allowed_ids))
+
+        with timed_stage("prepare"):
+            att = prepare_column(column_name, source_names[0], data)
+        with timed_stage("text_search"):
+            text_data = self.searcher.search_similar_text_data(INDEX_NAME, att.value_text, source_names, allowed_ids)
+        if types_search is not None:
+            types_data = types_search.get()
+        with timed_stage("classifier"):
+            return att.predict_type(types_data, text_data, self.classifier)
+
+    def _get_source_names(self, source_names=None):
+        """
+        Returns the source names to predict against.
 
-        # print(data)
-        for value in data:
-            att.add_value(value)
-        att.semantic_type = "to_predict"
-        att.prepare_data()
-        return att.predict_type(searcher.search_types_data(INDEX_NAME, source_names), searcher.search_similar_text_data(INDEX_NAME, att.value_text, source_names), self.classifier)
+        :param source_names: List of allowed source names, if this is None all of the source names in the db are used
+        :return: A list of source names
+        """
+        if source_names is not None:
+            return source_names
+        # If no source names are given just use all of the source names in the db
+        return self.source_catalog.source_names()
 
-    def _update_bulk_add_model(self, model, column_model):
+    def _get_allowed_type_ids(self, namespaces=None, models=None):
         """
-        Updates the bulk add model in the db and also returns it.
+        Returns the ids of the semantic types which are allowed in a prediction.
 
-        :param model:        The current bulk add model
-        :param column_model: The model of the columns which are being updated against
-        :return: The updated bulk add model
+        :param namespaces: List of allowed namespaces
+        :param models:     List of allowed column models
+        :return: A set of the allowed semantic type ids, or None if every semantic type is allowed
         """
-        for n in model[BAC_GRAPH][BAC_NODES]:
-            if n.get(BAC_COLUMN_NAME):
-                if n[BAC_COLUMN_NAME] == BAC_COLUMN_NAME_FILE_NAME:
-                    continue
-                column_id = get_column_id(get_type_id(n[BAC_USER_SEMANTIC_TYPES][0][BAC_CLASS][BAC_URI],
-                                                      n[BAC_USER_SEMANTIC_TYPES][0][BAC_PROPERTY][BAC_URI]),
-                                          n[BAC_COLUMN_NAME], model[BAC_NAME], column_model)
-                prediction = self._predict_column(n[BAC_COLUMN_NAME], [model[BAC_NAME]],
-                                                  self.db.find_one({DATA_TYPE: DATA_TYPE_COLUMN, ID: column_id})[DATA])
-                n[BAC_LEARNED_SEMANTIC_TYPES] = []
-                for t in prediction:
-                    type_info = decode_type_id(t[SL_SEMANTIC_TYPE])
-                    od = collections.OrderedDict()
-                    od[BAC_CLASS] = {BAC_URI: type_info[0]}
-                    od[BAC_PROPERTY] = {BAC_URI: type_info[1]}
-                    od[BAC_CONFIDENCE_SCORE] = t[SL_CONFIDENCE_SCORE]
-                    n[BAC_LEARNED_SEMANTIC_TYPES].append(od)
-        self.db.update_one({DATA_TYPE: DATA_TYPE_MODEL, ID: model[BAC_ID]}, {"$set": {BULK_ADD_MODEL_DATA: model}})
-        return model
+        allowed_ids_namespaces = None
+        allowed_ids_models = None
+        if namespaces is not None:
+            allowed_ids_namespaces = set()
+            for t in self.types.find({NAMESPACE: {"$in": namespaces}}, projection={ID: True}):
+                allowed_ids_namespaces.add(t[ID])
+        if models:
+            allowed_ids_models = set()
+            # Only asking for the type id lets the (model, typeId) index answer this without reading any columns
+            for c in self.columns.find({MODEL: {"$in": models}}, projection={ID: False, TYPE_ID: True}):
+                allowed_ids_models.add(c[TYPE_ID])
+        if allowed_ids_namespaces is not None and allowed_ids_models is not None:
+            return allowed_ids_namespaces & allowed_ids_models
+        elif allowed_ids_namespaces is not None:
+            return allowed_ids_namespaces
+        return allowed_ids_models
+
+    @staticmethod
+    def _format_predictions(predictions):
+        """
+        Turns the output of the semantic labeler into the list returned to the user.
+
+        :param predictions: The predictions from _predict_column
+        :return: A list of the predicted types sorted from most to least likely
+        """
+        return_body = []
+        for prediction in predictions:
+            for type_id, exact_score in prediction[1]:
+                obj_dict = {TYPE_ID_PATH: type_id, SCORE: exact_score}
+                type_class_property = decode_type_id(type_id)
+                obj_dict[CLASS] = type_class_property[0]
+                obj_dict[PROPERTY] = type_class_property[1]
+                return_body.append(obj_dict)
+        return_body.sort(key=lambda x: x[SCORE], reverse=True)
+        return return_body
+
+    def _update_bulk_add_models(self, db_models):
+        """
+        Updates the learnedSemanticTypes of the bulk add models in the db and also returns the models.
+
+        Notes: Only the nodes whose column's data has changed since their learnedSemanticTypes were last computed are
+        predicted again, the rest keep the learnedSemanticTypes which are already in the model.  The columns of all of
+        the models are looked up together and the ones which changed are sent to the crunch pool together.  With worker
+        processes (PREDICT_PROCESSES) the columns are predicted on every core at once, without them the threads only
+        overlap the searches and the CPU bound work is still done one column at a time.  Models where nothing changed
+        aren't written to the db at all.
+
+        :param db_models: List of the models' db documents, with their bulkAddData, model and crunchedVersions.  The
+                          crunchedAt of the ones which are updated is set on them
+        :return: A list of the updated bulk add models, in the same order
+        """
+        models = []
+        node_columns = []
+        for db_model in db_models:
+            model = db_model[BULK_ADD_MODEL_DATA]
+            models.append((model, dict(db_model.get(CRUNCHED_VERSIONS) or {})))
+            for n in model[BAC_GRAPH][BAC_NODES]:
+                if n.get(BAC_COLUMN_NAME) and n[BAC_COLUMN_NAME] != BAC_COLUMN_NAME_FILE_NAME:
+                    node_columns.append((len(models) - 1, n, get_column_id(
+                        get_type_id(n[BAC_USER_SEMANTIC_TYPES][0][BAC_CLASS][BAC_URI],
+                                    n[BAC_USER_SEMANTIC_TYPES][0][BAC_PROPERTY][BAC_URI]),
+                        n[BAC_COLUMN_NAME], model[BAC_NAME], db_model[MODEL])))
+
+        # The versions are read before the values, so data added while predicting makes the column stale again
+        columns = dict((column[ID], column) for column in self.columns.find(
+            {ID: {"$in": list(set(column_id for _, _, column_id in node_columns))}},
+            projection={DATA_VERSION: True, VALUE_COUNT: True}))
+        stale = []
+        for i, n, column_id in node_columns:
+            crunched_versions = models[i][1]
+            if column_id not in columns:
+                continue
+            if BAC_LEARNED_SEMANTIC_TYPES in n and column_id in crunched_versions and \
+                    crunched_versions[column_id] == columns[column_id].get(DATA_VERSION):
+                continue
+            crunched_versions[column_id] = columns[column_id].get(DATA_VERSION)
+            stale.append((i, n, column_id))
+        if not stale:
+            return [model for model, _ in models]
+        values = dict((column[ID], column[COLUMN_VALUES]) for column in self.storage.with_values(
+            [columns[column_id] for column_id in set(column_id for _, _, column_id in stale)
+             if columns[column_id].get(VALUE_COUNT)]))
+        # A column without any values has nothing to predict from, so its node is left with no learnedSemanticTypes
+        predicted = [(i, n, column_id) for i, n, column_id in stale if values.get(column_id)]
+        for _, n, _ in stale:
+            n[BAC_LEARNED_SEMANTIC_TYPES] = []
+
+        # The types search only depends on the source, which is the model's name, so it is done once for each model
+        # (unless the columns are predicted by worker processes, which search for it themselves)
+        types_searches = dict((name, search_pool.apply_async(in_current_method(_search_types_data),
+                                                             (self.searcher, [name], None)))
+                              for name in set(models[i][0][BAC_NAME] for i, _, _ in predicted)) \
+            if self.prediction_pool is None else {}
+        types_data = dict((name, search.get()) for name, search in types_searches.items())
+        predictions = [crunch_pool.apply_async(in_current_method(self._predict_column), (
+            n[BAC_COLUMN_NAME], [models[i][0][BAC_NAME]], values[column_id], types_data.get(models[i][0][BAC_NAME])))
+                       for i, n, column_id in predicted]
+        for (i, n, column_id), prediction in zip(predicted, predictions):
+            for t in self._format_predictions(prediction.get()):
+                od = collections.OrderedDict()
+                od[BAC_CLASS] = {BAC_URI: t[CLASS]}
+                od[BAC_PROPERTY] = {BAC_URI: t[PROPERTY]}
+                od[BAC_CONFIDENCE_SCORE] = t[SCORE]
+                n[BAC_LEARNED_SEMANTIC_TYPES].append(od)
+
+        crunched_at = time.time()
+        updated = sorted(set(i for i, _, _ in stale))
+        self.models.bulk_write([UpdateOne({ID: models[i][0][BAC_ID]},
+                                          {"$set": {BULK_ADD_MODEL_DATA: models[i][0],
+                                                    CRUNCHED_VERSIONS: models[i][1], CRUNCHED_AT: crunched_at}})
+                                for i in updated], ordered=False)
+        for i in updated:
+            db_models[i][CRUNCHED_AT] = crunched_at
+        return [model for model, _ in models]
+
+    def _queue_crunch(self, db_body):
+        """
+        Marks the bulk add models which match the query as pending and queues a background job which updates their
+        learnedSemanticTypes, unless one is already queued for them.
+
+        :param db_body: Query of the models whose columns' data has changed
+        """
+        model_ids = [m[ID] for m in self.models.find(db_body, projection={ID: True})]
+        # Only the set is guarded, so appends never wait on each other's db round trips
+        with self._crunch_lock:
+            queued = [model_id for model_id in model_ids if model_id not in self._crunch_queued]
+            self._crunch_queued.update(queued)
+        if not queued:
+            return
+        # Marked pending before the jobs are submitted, so a job never finishes before it is marked
+        self.models.update_many({ID: {"$in": queued}}, {"$set": {CRUNCH_PENDING: True}})
+        for model_id in queued:
+            self.jobs.submit("crunch_bulk_add_model", lambda job, m=model_id: self._crunch_bulk_add_model(m))
+
+    @server_method
+    def _crunch_bulk_add_model(self, model_id):
+        """
+        Updates the learnedSemanticTypes of a bulk add model, this is the background job queued by _queue_crunch.
+
+        :param model_id: The id of the model
+        :return: A conformation message with a 200, or an error message with a 404 if the model no longer exists
+        """
+        # Data added from here on queues another job, since the data this one reads may not include it
+        with self._crunch_lock:
+            self._crunch_queued.discard(model_id)
+        db_model = self.models.find_one({ID: model_id}, projection={MODEL: True, BULK_ADD_MODEL_DATA: True,
+                                                                    CRUNCHED_VERSIONS: True})
+        if db_model is None:
+            return "The model was deleted before it was updated", 404
+        try:
+            self._update_bulk_add_models([db_model])
+        finally:
+            with self._crunch_lock:
+                pending = model_id in self._crunch_queued
+            self.models.update_one({ID: model_id}, {"$set": {CRUNCH_PENDING: pending}})
+            # A crunch queued while that was written may have marked the model before this unmarked it
+            if not pending:
+                with self._crunch_lock:
+                    pending = model_id in self._crunch_queued
+                if pending:
+                    self.models.update_one({ID: model_id}, {"$set": {CRUNCH_PENDING: True}})
+        return "Model updated", 200
 
     ################ Predict ################
 
+    @server_method
     def predict_post(self, data, namespaces=None, column_names=None, source_names=None, models=None):
         """
         Predicts the semantic type of the given data.
@@ -104,64 +563,84 @@ class Server(object):
         :param column_names: List of allowed column names
         :param source_names: List of allowed source names
         :param models:       List of allowed column models
-        :param data:         List of the data values to predict.
+        :param data:         Iterable of the data values to predict, such as the lines of the request body.  It is only read through once and at most SAMPLE_SIZE of the values are kept
         :return: A return message (if it is successful this will be a list of the predicted types) and a return code
         """
-        data = [x.strip() for x in data]
-        data = [x for x in data if x]
+        data_fingerprint = Fingerprint()
+        data = reservoir_sample(data_fingerprint.consume(clean_values(data)), SAMPLE_SIZE)
         if not data:
-            return "Predicting data cannot be empty", 500
-        if source_names is None:
-            # If no source names are given just use all of the source names in the db
-            source_names = set()
-            for col in self.db.find({DATA_TYPE: DATA_TYPE_COLUMN}):
-                source_names.add(col[SOURCE_NAME])
-            source_names = list(source_names)
+            return "Predicting data cannot be empty", 400
+        key = data_fingerprint.hexdigest(column_names[0], namespaces, source_names, models)
+        cached = self.prediction_cache.get(key)
+        if cached is not None:
+            return json_response(cached, 200)
+        epoch = self.prediction_cache.epoch
+        source_names = self._get_source_names(source_names)
         if len(source_names) < 1: return "You must have columns to be able to predict", 400
 
+        ## Only the columns of allowed semantic types are searched for and scored
+        allowed_ids = self._get_allowed_type_ids(namespaces, models)
+        if allowed_ids is not None and len(allowed_ids) < 1: return "No matches found", 404
+
         #### Predict the types
         ## Do the actual predicting using the semantic labeler
-        predictions = self._predict_column(column_names[0], source_names, data)
+        predictions = self._predict_column(column_names[0], source_names, data, allowed_ids=allowed_ids)
         if len(predictions) < 1: return "No matches found", 404
+        return_body = self._format_predictions(predictions)
+        self.prediction_cache.put(key, return_body, epoch)
+        return json_response(return_body, 200)
+
+    @server_method
+    def predict_cache_get(self):
+        """
+        Returns the size and hit/miss counts of the prediction cache.
+
+        :return: The stats of the prediction cache and a 200
+        """
+        return json_response(self.prediction_cache.stats(), 200)
+
+    @server_method
+    def predict_batch_post(self, columns, namespaces=None, source_names=None, models=None):
+        """
+        Predicts the semantic types of many columns at once.
+
+        Notes: The source names, allowed semantic types and the search of the types data are only looked up once and
+        shared by all of the columns.
+
+        :param columns:      List of dictionaries which each have the name of a column and the list of its data values,
+                             which can be strings, numbers, booleans or nulls (which are skipped)
+        :param namespaces:   List of allowed namespaces
+        :param source_names: List of allowed source names
+        :param models:       List of allowed column models
+        :return: A return message (if it is successful this will be a list with the predicted types of each column) and a return code
+        """
+        source_names = self._get_source_names(source_names)
+        if len(source_names) < 1: return "You must have columns to be able to predict", 400
+        allowed_ids = self._get_allowed_type_ids(namespaces, models)
+        # Worker processes search for the types data themselves, so it is only searched here without them
+        types_data = _search_types_data(self.searcher, source_names, allowed_ids) \
+            if self.prediction_pool is None and (allowed_ids is None or len(allowed_ids) > 0) else None
 
-        ## Filter the results
-        allowed_ids_namespaces = None
-        allowed_ids_models = None
-        all_allowed_ids = None
-        if namespaces is not None:
-            allowed_ids_namespaces = set()
-            current_allowed_types = list(
-                self.db.find({DATA_TYPE: DATA_TYPE_SEMANTIC_TYPE, NAMESPACE: {"$in": namespaces}}))
-            for prediction in current_allowed_types:
-                allowed_ids_namespaces.add(prediction[ID])
-        if models:
-            allowed_ids_models = set()
-            current_allowed_types = list(self.db.find({DATA_TYPE: DATA_TYPE_COLUMN, MODEL: {"$in": models}}))
-            for c in current_allowed_types:
-                allowed_ids_models.add(c[TYPE_ID])
-        if allowed_ids_namespaces is not None and allowed_ids_models is not None:
-            all_allowed_ids = allowed_ids_namespaces & allowed_ids_models
-        elif allowed_ids_namespaces is not None and allowed_ids_models is None:
-            all_allowed_ids = allowed_ids_namespaces
-        elif allowed_ids_namespaces is None and allowed_ids_models is not None:
-            all_allowed_ids = allowed_ids_models
         return_body = []
-        for prediction in predictions:
-            print(prediction)
-            for type_id, exact_score in prediction[1]:
-                if all_allowed_ids is not None:
-                    if prediction[SL_SEMANTIC_TYPE] not in all_allowed_ids:
-                        continue
-                obj_dict = {TYPE_ID_PATH: type_id, SCORE: exact_score}
-                type_class_property = decode_type_id(type_id)
-                obj_dict[CLASS] = type_class_property[0]
-                obj_dict[PROPERTY] = type_class_property[1]
-                return_body.append(obj_dict)
-        return_body.sort(key=lambda x: x[SCORE], reverse=True)
+        for col in columns:
+            o = collections.OrderedDict()
+            o[COLUMN_NAME] = col.get(COLUMN_NAME) or DEFAULT_NAME
+            # The values can be any json scalar, numbers and booleans are predicted as their text and nulls skipped
+            data = reservoir_sample(clean_values(unicode(value) for value in col.get(DATA) or [] if value is not None),
+                                    SAMPLE_SIZE)
+            if not data:
+                o[ERROR] = "Predicting data cannot be empty"
+            elif allowed_ids is not None and len(allowed_ids) < 1:
+                o[PREDICTIONS] = []
+            else:
+                o[PREDICTIONS] = self._format_predictions(
+                    self._predict_column(o[COLUMN_NAME], source_names, data, types_data, allowed_ids))
+            return_body.append(o)
         return json_response(return_body, 200)
 
     ################ SemanticTypes ################
 
+    @server_method
     def semantic_types_get(self, class_=None, property_=None, namespaces=None, source_names=None, column_names=None,
                            column_ids=None, models=None, return_columns=False, return_column_data=False):
         """
@@ -179,24 +658,24 @@ class Server(object):
         :return: All of the semantic types which fit the following parameters
         """
         # Find all of the type ids that satisfy the class, property, and namespaces
-        db_body = {DATA_TYPE: DATA_TYPE_SEMANTIC_TYPE}
+        db_body = {}
         if class_ is not None: db_body[CLASS] = class_
         if property_ is not None: db_body[PROPERTY] = property_
         if namespaces is not None: db_body[NAMESPACE] = {"$in": namespaces}
-        possible_result = list(self.db.find(db_body))
+        possible_result = list(self.types.find(db_body, projection={CLASS: True, PROPERTY: True, NAMESPACE: True}))
         possible_type_ids = set()
         for t in possible_result:
             possible_type_ids.add(t[ID])
 
         # Find all of the type ids from the columns which satisfy the other parameters
         if source_names or column_names or column_ids or models:
-            db_body = {DATA_TYPE: DATA_TYPE_COLUMN}
+            db_body = {}
             if source_names is not None: db_body[SOURCE_NAME] = {"$in": source_names}
             if column_names is not None: db_body[COLUMN_NAME] = {"$in": column_names}
             if column_ids is not None: db_body[ID] = {"$in": column_ids}
             if models is not None: db_body[MODEL] = {"$in": models}
             other_possible_ids = set()
-            for col in self.db.find(db_body):
+            for col in self.columns.find(db_body, projection={TYPE_ID: True}):
                 other_possible_ids.add(col[TYPE_ID])
             possible_type_ids = possible_type_ids & other_possible_ids
 
@@ -213,14 +692,19 @@ class Server(object):
 
         # Add the column data if requested
         if return_columns:
-            db_body = {DATA_TYPE: DATA_TYPE_COLUMN}
+            db_body = {}
             for type_ in return_body:
                 db_body[TYPE_ID] = type_[TYPE_ID_PATH]
-                type_[COLUMNS] = clean_columns_output(self.db.find(db_body), return_column_data)
+                columns = self.columns.find(db_body, projection=column_projection())
+                if return_column_data:
+                    columns = self.storage.with_values(columns)
+                type_[COLUMNS] = clean_columns_output(columns, return_column_data)
 
         if len(return_body) < 1: return "No Semantic types matching the given parameters were found", 404
         return json_response(return_body, 200)
 
+    @invalidates_predictions
+    @server_method
     def semantic_types_post_put(self, class_, property_, force=False):
         """
         Creates a semantic type and returns the id if it was successful.
@@ -232,25 +716,19 @@ class Server(object):
         :param force:     Force create the semantic type, if this is true and the type already exists the existing type (and all of its columns and data) will be deleted before creation
         :return: The id of the new semantic type and a response code of 201 if the creation was successful, otherwise it will be an error message with the appropriate error code
         """
-        class_ = class_.rstrip("/")
-        property_ = property_.rstrip("/")
-
-        ## Verify that class is a valid uri and namespace is a valid uri
-        namespace = "/".join(class_.replace("#", "/").split("/")[:-1])
-
-        ## Actually add the type
-        type_id = get_type_id(class_, property_)
-        db_body = {ID: type_id, DATA_TYPE: DATA_TYPE_SEMANTIC_TYPE, CLASS: class_, PROPERTY: property_,
-                   NAMESPACE: namespace}
-        if self.db.find_one(db_body):
+        db_body = self._type_document(class_, property_)
+        type_id = db_body[ID]
+        if self.types.find_one(db_body, projection={ID: True}):
             if force:
-                self.db.delete_many({DATA_TYPE: DATA_TYPE_COLUMN, TYPE_ID: type_id})
-                self.db.delete_many(db_body)
+                self._delete_columns({TYPE_ID: type_id})
+                self.types.delete_many(db_body)
             else:
                 return type_id, 409
-        self.db.insert_one(db_body)
+        self.types.insert_one(db_body)
         return type_id, 201
 
+    @invalidates_predictions
+    @server_method
     def semantic_types_delete(self, class_=None, property_=None, type_ids=None, namespaces=None, source_names=None,
                               column_names=None, column_ids=None, models=None, delete_all=False):
         """
@@ -269,16 +747,11 @@ class Server(object):
         """
         if class_ is None and property_ is None and type_ids is None and namespaces is None and source_names is None and column_names is None and column_ids is None and models is None and not delete_all:
             return "To delete all semantic types give deleteAll as true", 400
-            return "All " + str(self.db.delete_many({DATA_TYPE: {"$in": [DATA_TYPE_SEMANTIC_TYPE,
-                                                                         DATA_TYPE_COLUMN]}}).deleted_count) + " semantic types and their data were deleted", 200
-
-
-        print str(class_)+" "+str(property_)+" "+str(type_ids)+" "+str(namespaces)+" "+str(source_names)+" "+str(column_names)+" "+str(column_ids)+" "+str(models)+" "+str(delete_all)
 
         # Find the parent semantic types and everything below them of everything which meets column requirements
         type_ids_to_delete = []
-        db_body = {DATA_TYPE: DATA_TYPE_COLUMN}
-        db_body_id = {DATA_TYPE: DATA_TYPE_SEMANTIC_TYPE}
+        db_body = {}
+        db_body_id = {}
         if type_ids is not None:
             db_body[TYPE_ID] = {"$in": type_ids}
             db_body_id[ID] = {"$in": type_ids}
@@ -287,42 +760,40 @@ class Server(object):
         if column_names is not None: db_body[COLUMN_NAME] = {"$in": column_names}
         if column_ids is not None: db_body[COLUMN_ID_PATH] = {"$in": column_ids}
         if models is not None: db_body[MODEL] = {"$in": models}
-        for col in self.db.find(db_body):
-            print "col[TYPE_ID] = "+str(col[TYPE_ID])
+        for col in self.columns.find(db_body, projection={TYPE_ID: True}):
             if col[TYPE_ID] not in type_ids_to_delete:
                 type_ids_to_delete.append(col[TYPE_ID])
-        for col in self.db.find(db_body_id):
-            print "col[ID] = "+str(col[ID])
+        for col in self.types.find(db_body_id, projection={ID: True}):
             if col[ID] not in type_ids_to_delete:
                 type_ids_to_delete.append(col[ID])
         # Find the semantic types which meet the other requirements and delete all types which need to be
         possible_types = []
-        db_body = {DATA_TYPE: DATA_TYPE_SEMANTIC_TYPE}
+        db_body = {}
         if class_ is not None: db_body[CLASS] = class_
         if property_ is not None: db_body[PROPERTY] = property_
         if namespaces is not None: db_body[NAMESPACE] = {"$in": namespaces}
 
         if type_ids is None and source_names is None and column_names is None and column_ids is None and models is None:
-            deleted = self.db.delete_many(db_body).deleted_count
+            deleted = self.types.delete_many(db_body).deleted_count
         else:
-            for t in self.db.find(db_body):
+            for t in self.types.find(db_body, projection={ID: True}):
                 if t[ID] not in possible_types:
                     possible_types.append(t[ID])
-            for t in self.db.find(db_body_id):
+            for t in self.types.find(db_body_id, projection={ID: True}):
                 if t[ID] not in possible_types:
                     possible_types.append(t[ID])
             for id_ in type_ids_to_delete:
                 if id_ not in possible_types:
                     type_ids_to_delete.remove(id_)
-            db_body = {DATA_TYPE: DATA_TYPE_COLUMN, TYPE_ID: {"$in": type_ids_to_delete}}
-            self.db.delete_many(db_body)
-            deleted = self.db.delete_many(
-                {DATA_TYPE: DATA_TYPE_SEMANTIC_TYPE, ID: {"$in": type_ids_to_delete}}).deleted_count
+            db_body = {TYPE_ID: {"$in": type_ids_to_delete}}
+            self._delete_columns(db_body)
+            deleted = self.types.delete_many({ID: {"$in": type_ids_to_delete}}).deleted_count
         if deleted < 1: return "No semantic types with the given parameters were found", 404
         return str(deleted) + " semantic types matched parameters and were deleted", 200
 
     ################ SemanticTypesColumns ################
 
+    @server_method
     def semantic_types_columns_get(self, type_id, column_ids=None, column_names=None, source_names=None, models=None,
                                    return_column_data=False):
         """
@@ -336,16 +807,18 @@ class Server(object):
         :param return_column_data: True if all of the data in the column should be returned with the columns
         :return: All of the columns in the semantic type that fit the given parameters
         """
-        print(type_id)
-        db_body = {DATA_TYPE: DATA_TYPE_COLUMN, TYPE_ID: type_id}
+        db_body = {TYPE_ID: type_id}
         if source_names is not None: db_body[SOURCE_NAME] = {"$in": source_names}
         if column_names is not None: db_body[COLUMN_NAME] = {"$in": column_names}
         if column_ids is not None: db_body[ID] = {"$in": column_ids}
         if models is not None: db_body[MODEL] = {"$in": models}
-        result = list(self.db.find(db_body))
+        result = list(self.columns.find(db_body, projection=column_projection()))
         if len(result) < 1: return "No columns matching the given parameters were found", 404
+        if return_column_data: result = self.storage.with_values(result)
         return json_response(clean_columns_output(result, return_column_data), 200)
 
+    @invalidates_predictions
+    @server_method
     def semantic_types_columns_post_put(self, type_id, column_name, source_name, model, data=[], force=False):
         """
         Create a column in a semantic type, optionally with data.
@@ -361,14 +834,14 @@ class Server(object):
         column = Column(column_name, source_name)
         column.semantic_type = type_id
 
-        #if the size of the training data is MORE than a threshold value, then sample the threshold values randomly
-        if(len(data)>SAMPLE_SIZE): data = random.sample(data, SAMPLE_SIZE)
-
+        # The data is sampled down to SAMPLE_SIZE values when the column is stored
         for value in data:
             column.add_value(value)
         result = self._create_column(column, type_id, column_name, source_name, model, force)
         return result
 
+    @invalidates_predictions
+    @server_method
     def semantic_types_columns_delete(self, type_id, column_ids=None, column_names=None, source_names=None,
                                       models=None):
         """
@@ -381,17 +854,18 @@ class Server(object):
         :param models:       The possible models of the columns to delete
         :return: The number of columns deteled with a 200 if successful, otherwise an error message with an appropriate error code
         """
-        db_body = {DATA_TYPE: DATA_TYPE_COLUMN, TYPE_ID: type_id}
+        db_body = {TYPE_ID: type_id}
         if source_names is not None: db_body[SOURCE_NAME] = {"$in": source_names}
         if column_names is not None: db_body[COLUMN_NAME] = {"$in": column_names}
         if column_ids is not None: db_body[ID] = {"$in": column_ids}
         if models is not None: db_body[MODEL] = {"$in": models}
-        found_columns = list(self.db.find(db_body))
-        if len(found_columns) < 1: return "No columns were found with the given parameters", 404
-        return str(self.db.delete_many(db_body).deleted_count) + " columns deleted successfully", 200
+        if self.columns.find_one(db_body, projection={ID: True}) is None:
+            return "No columns were found with the given parameters", 404
+        return str(self._delete_columns(db_body)) + " columns deleted successfully", 200
 
     ################ SemanticTypesColumnData ################
 
+    @server_method
     def semantic_types_column_data_get(self, column_id):
         """
         Returns all of the data in the column
@@ -399,40 +873,43 @@ class Server(object):
         :param column_id: Id of the column to get the data from
         :return: The column and all of its info
         """
-        result = list(self.db.find({DATA_TYPE: DATA_TYPE_COLUMN, ID: column_id}))
-        if len(result) < 1: return "No column with that id was found", 404
-        if len(result) > 1: return "More than one column was found with that id", 500
-        return json_response(clean_column_output(result[0]), 200)
-
-    def semantic_types_column_data_post_put(self, column_id, body, force=False):
+        column = self.columns.find_one({ID: column_id}, projection=column_projection())
+        if column is None: return "No column with that id was found", 404
+        column[COLUMN_VALUES] = list(self.storage.read_values(column_id))
+        return json_response(clean_column_output(column), 200)
+
+    @invalidates_predictions
+    @server_method
+    def semantic_types_column_data_post_put(self, column_id, body, force=False, wait_for_visibility=False):
         """
         Add or replace data on an existing column
 
-        Notes: If the column does not exist a 404 will be returned
+        Notes: If the column does not exist a 404 will be returned.  An append takes two MongoDB requests (see
+        Storage.append_values for why), one bulk request to the search index, and a lookup of the bulk add models the
+        column belongs to only when its source and model can be one's
 
-        :param column_id: Id of the column to add/replace the data of
-        :param body:      An array of the new data
-        :param force:     True if the current data in the column should be replaced, false if the new data should just be appended
+        :param column_id:           Id of the column to add/replace the data of
+        :param body:                An array of the new data
+        :param force:               True if the current data in the column should be replaced, false if the new data should just be appended
+        :param wait_for_visibility: True if this shouldn't return until predicts can see the new data
         :return: A conformation with a 201 if it was added successfully or an error message with an appropriate error code if it was not successful
         """
-
-        column_data = self.db.find_one({DATA_TYPE: DATA_TYPE_COLUMN, ID: column_id})
-        if column_data.matched_count < 1: return "No column with that id was found", 404
-        if column_data.matched_count > 1: return "More than one column was found with that id", 500
-
-        column = Column(column_data[COLUMN_NAME], column_data[SOURCE_NAME], get_type_from_column_id(column_id))
-        if not force:
-            column.read_json_to_column(column_data)
-
-
-        for value in body:
-            column.add_value(value)
-
-        data = column.to_json()
-        self.db.update_many(data)
-
+        body = list(body)
+        if force:
+            column = self.storage.replace_values(column_id, body)
+            if column is None: return "No column with that id was found", 404
+            self.indexer.index_columns(INDEX_NAME, [column])
+        elif not self._append_values([(column_id, body)]):
+            return "No column with that id was found", 404
+        if wait_for_visibility: self.indexer.refresh(INDEX_NAME)
+        # The column belongs to a bulk add model if its source and model are the model's name and column model
+        source_name, model = get_source_and_model_from_column_id(column_id)
+        if self.bulk_add_model_catalog.may_contain(source_name, model):
+            self._queue_crunch({NAME: source_name, MODEL: model})
         return "Column data updated", 201
 
+    @invalidates_predictions
+    @server_method
     def semantic_types_column_data_delete(self, column_id):
         """
         Delete the data from the column with the given id
@@ -440,18 +917,20 @@ class Server(object):
         :param column_id: Id of the column to delete the data from
         :return: A deletion conformation with a 200 if successful, otherwise an error message with an appropriate error code
         """
-        result = self.db.update_many({DATA_TYPE: DATA_TYPE_COLUMN, ID: column_id}, {"$set": {DATA: []}})
-        if result.matched_count < 1: return "No column with that id was found", 404
-        if result.matched_count > 1: return "More than one column was found with that id", 500
-        column = self.db.find_one({DATA_TYPE: DATA_TYPE_COLUMN, ID: column_id})
-
-        self.db.delete_one({DATA_TYPE: DATA_TYPE_COLUMN, TYPE_ID: get_type_from_column_id(column_id)})
-
-        self.db.delete_one({DATA_TYPE: DATA_TYPE_COLUMN, ID: column_id})
+        if self.columns.find_one({ID: column_id}, projection={ID: True}) is None:
+            return "No column with that id was found", 404
+
+        for db_body in [{TYPE_ID: get_type_from_column_id(column_id)}, {ID: column_id}]:
+            deleted = self.columns.find_one_and_delete(db_body, projection={SOURCE_NAME: True})
+            if deleted:
+                self.storage.delete_values([deleted[ID]])
+                self.source_catalog.remove({deleted[SOURCE_NAME]: 1})
+                self.indexer.delete_columns(INDEX_NAME, [deleted[ID]])
         return "Column data deleted", 200
 
     ################ BulkAddModels ################
 
+    @server_method
     def bulk_add_models_get(self, model_ids=None, model_names=None, model_desc=None, show_all=False, crunch_data=True):
         """
         Returns the current state of all of the bulk add models.
@@ -463,25 +942,33 @@ class Server(object):
         :param crunch_data: False if learnedSemanticTypes should not be generated and the version in the db should be used instead, note that the data in the db is updated every time a get is run with crunch_data=true
         :return: All of the models that fit the given parameters
         """
-        db_body = {DATA_TYPE: DATA_TYPE_MODEL}
+        db_body = {}
         if model_ids is not None: db_body[ID] = {"$in": model_ids}
         if model_names is not None: db_body[NAME] = {"$in": model_names}
         if model_desc is not None: db_body[MODEL_DESC] = model_desc
-        db_result = list(self.db.find(db_body))
+        # The whole bulk add model is only loaded when it is going to be returned
+        db_result = list(self.models.find(db_body, projection=None if show_all else {
+            NAME: True, DESC: True, CRUNCHED_AT: True, CRUNCH_PENDING: True}))
         if len(db_result) < 1: return "No models were found with the given parameters", 404
 
         # Construct the return body
+        if show_all:
+            models = self._update_bulk_add_models(db_result) if crunch_data else [mod[BULK_ADD_MODEL_DATA]
+                                                                                 for mod in db_result]
         return_body = []
-        for mod in db_result:
+        for i, mod in enumerate(db_result):
             o = collections.OrderedDict()
             o[MODEL_ID] = mod[ID]
             o[NAME] = mod[NAME]
             o[DESC] = mod[DESC]
-            if show_all: o[MODEL] = self._update_bulk_add_model(mod[BULK_ADD_MODEL_DATA],
-                                                                mod[MODEL]) if crunch_data else mod[BULK_ADD_MODEL_DATA]
+            if show_all: o[MODEL] = models[i]
+            o[CRUNCHED_AT] = mod.get(CRUNCHED_AT)
+            o[CRUNCH_PENDING] = mod.get(CRUNCH_PENDING, False)
             return_body.append(o)
         return json_response(return_body, 200)
 
+    @invalidates_predictions
+    @server_method
     def bulk_add_models_post(self, model, column_model=DEFAULT_BULK_MODEL):
         """
         Add a bulk add model.
@@ -496,48 +983,75 @@ class Server(object):
         if BAC_DESC not in model: return "The given model must have a description", 400
         if BAC_GRAPH not in model: return "The given model must have a graph", 400
         if BAC_NODES not in model[BAC_GRAPH]: return "The given model must have nodes within the graph", 400
-        if len(list(self.db.find({ID: model[BAC_ID]}))) > 0: return "Model id already exists", 409
+        if self.models.find_one({ID: model[BAC_ID]}, projection={ID: True}): return "Model id already exists", 409
 
         #### Parse and add the model
-        # Try to add of the given semantic types and columns
+        # Work out all of the semantic types and columns in the model first, so they can be checked and added at once
+        types = collections.OrderedDict()
+        columns = collections.OrderedDict()
+        added = []
+        for n in model[BAC_GRAPH][BAC_NODES]:
+            if n.get(BAC_USER_SEMANTIC_TYPES):
+                for ust in n[BAC_USER_SEMANTIC_TYPES]:
+                    type_body = self._type_document(ust[BAC_CLASS][BAC_URI], ust[BAC_PROPERTY][BAC_URI])
+                    types.setdefault(type_body[ID], type_body)
+                    type_id = get_type_id(ust[BAC_CLASS][BAC_URI], ust[BAC_PROPERTY][BAC_URI])
+                    column = Column(n[BAC_COLUMN_NAME], model[BAC_NAME])
+                    column.semantic_type = type_id
+                    column_body = self._column_document(column, type_id, n[BAC_COLUMN_NAME], model[BAC_NAME],
+                                                        column_model)[0]
+                    columns.setdefault(column_body[ID], column_body)
+                    added.append((type_body[ID], column_body[ID]))
+        existing_types = set(t[ID] for t in self.types.find({ID: {"$in": list(types)}}, projection={ID: True}))
+        existing_columns = set(c[ID] for c in self.columns.find({ID: {"$in": list(columns)}}, projection={ID: True}))
+
+        # Count them the same way as adding them one at a time would, where adding one a second time finds it existing
         new_type_count = 0
         new_column_count = 0
         existed_type_count = 0
         existed_column_count = 0
-        for n in model[BAC_GRAPH][BAC_NODES]:
-            if n.get(BAC_USER_SEMANTIC_TYPES):
-                for ust in n[BAC_USER_SEMANTIC_TYPES]:
-                    semantic_status = self.semantic_types_post_put(ust[BAC_CLASS][BAC_URI], ust[BAC_PROPERTY][BAC_URI],
-                                                                   False)
-                    if semantic_status[1] == 201:
-                        new_type_count += 1
-                    elif semantic_status[1] == 409:
-                        existed_type_count += 1
-                    elif semantic_status[1] == 400:
-                        return semantic_status
-                    else:
-                        return "Error occurred while adding semantic type: " + str(ust), 500
-                    column_status = self._create_column(
-                        get_type_id(ust[BAC_CLASS][BAC_URI], ust[BAC_PROPERTY][BAC_URI]), n[BAC_COLUMN_NAME],
-                        model[BAC_NAME], column_model)
-                    if column_status[1] == 201:
-                        new_column_count += 1
-                    elif column_status[1] == 409:
-                        existed_column_count += 1
-                    elif column_status[1] == 400:
-                        return column_status
-                    else:
-                        return "Error occurred while adding column for semantic type: " + str(ust), 500
+        seen_types = set(existing_types)
+        seen_columns = set(existing_columns)
+        for type_id, column_id in added:
+            if type_id in seen_types:
+                existed_type_count += 1
+            else:
+                new_type_count += 1
+                seen_types.add(type_id)
+            if column_id in seen_columns:
+                existed_column_count += 1
+            else:
+                new_column_count += 1
+                seen_columns.add(column_id)
+
+        # The upserts only insert, so anything created by another request in the meantime is left as it is
+        type_upserts = [_insert_only(body) for type_id, body in types.items() if type_id not in existing_types]
+        if type_upserts:
+            self.types.bulk_write(type_upserts, ordered=False)
+        column_bodies = [body for column_id, body in columns.items() if column_id not in existing_columns]
+        if column_bodies:
+            result = self.columns.bulk_write([_insert_only(body) for body in column_bodies], ordered=False)
+            created = [column_bodies[i] for i in sorted(result.upserted_ids)]
+            if created:
+                self.source_catalog.add(model[BAC_NAME], len(created))
+                for body in created:
+                    body[COLUMN_VALUES] = []
+                self.indexer.index_columns(INDEX_NAME, created)
 
         # Nothing bad happened when creating the semantic types and columns, so add the model to the DB
-        self.db.insert_one(
-            {DATA_TYPE: DATA_TYPE_MODEL, ID: model["id"], NAME: model[BAC_NAME], DESC: model["description"],
-             MODEL: column_model, BULK_ADD_MODEL_DATA: model})
+        try:
+            self.models.insert_one({ID: model["id"], NAME: model[BAC_NAME], DESC: model["description"],
+                                    MODEL: column_model, BULK_ADD_MODEL_DATA: model})
+        except DuplicateKeyError:
+            return "Model id already exists", 409
+        self.bulk_add_model_catalog.add(model[BAC_NAME], column_model)
         return "Model and columns added, " + str(new_type_count) + " semantic types created, " + \
                str(existed_type_count) + " semantic types already existed, " + \
                str(new_column_count) + " columns created, and " + \
                str(existed_column_count) + " columns already existed.", 201
 
+    @invalidates_predictions
+    @server_method
     def bulk_add_models_delete(self, model_ids=None, model_names=None, model_desc=None):
         """
         Delete all of the bulk add models which fit the given parameters
@@ -547,14 +1061,14 @@ class Server(object):
         :param model_desc:  The possible descriptions of the models to delete
         :return: The amount of models deleted with a 200 if successful, otherwise an error message with the appropriate code
         """
-        db_body = {DATA_TYPE: DATA_TYPE_MODEL}
+        db_body = {}
         if model_ids is not None:
             db_body[ID] = {"$in": model_ids}
         if model_names is not None:
             db_body[NAME] = {"$in": model_names}
         if model_desc is not None:
             db_body[MODEL_DESC] = model_desc
-        deleted_count = self.db.delete_many(db_body).deleted_count
+        deleted_count = self.models.delete_many(db_body).deleted_count
 
         if deleted_count < 1:
             return "No models were found with the given parameters", 404
@@ -562,57 +1076,148 @@ class Server(object):
 
     ################ BulkAddModelData ################
 
+    @server_method
     def bulk_add_model_data_get(self, model_id, crunch_data):
         """
         Returns the current state of the bulk add model
 
         :param model_id:    The id of the model to get
         :param crunch_data: False if learnedSemanticTypes should not be generated and the version in the db should be used instead, note that the data in the db is updated every time a get is run with crunch_data=true
-        :return: The current state of the bulk add model
+        :return: The current state of the bulk add model, with when its learnedSemanticTypes were computed and if they are being computed again
         """
-        db_result = list(self.db.find({DATA_TYPE: DATA_TYPE_MODEL, ID: model_id}))
+        db_result = list(self.models.find({ID: model_id}, projection={MODEL: True, BULK_ADD_MODEL_DATA: True,
+                                                                      CRUNCHED_VERSIONS: True, CRUNCHED_AT: True,
+                                                                      CRUNCH_PENDING: True}))
         if len(db_result) < 1:
             return "A model was not found with the given id", 404
         if len(db_result) > 1:
             return "More than one model was found with the given id", 500
         db_result = db_result[0]
-        return json_response(
-            self._update_bulk_add_model(db_result[BULK_ADD_MODEL_DATA], db_result[MODEL]) if crunch_data else db_result[
-                BULK_ADD_MODEL_DATA], 200)
-
-    def bulk_add_model_data_post(self, model_id, column_model, data):
+        model = self._update_bulk_add_models([db_result])[0] if crunch_data else db_result[BULK_ADD_MODEL_DATA]
+        model[CRUNCHED_AT] = db_result.get(CRUNCHED_AT)
+        model[CRUNCH_PENDING] = db_result.get(CRUNCH_PENDING, False)
+        return json_response(model, 200)
+
+    @invalidates_predictions
+    @server_method
+    def bulk_add_model_data_post(self, model_id, column_model, data, job=None, wait_for_visibility=False):
         """
         Add data to the service with a bulk add model
 
-        :param model_id:     The id of the model to add off of
-        :param column_model: The model of the columns being used with that model
-        :param data:         The list of dictionaries with all of the data to add
-        :return: A conformation message with a 201 if it was successful, otherwise an error message with the appropriate code
+        :param model_id:            The id of the model to add off of
+        :param column_model:        The model of the columns being used with that model
+        :param data:                Iterable of the dictionaries (rows) with the data to add, it is only iterated once
+                                    and may raise a JsonLinesError part way through, such as json_lines
+        :param job:                 The (optional) Job to report the rows processed and the columns written on
+        :param wait_for_visibility: True if this shouldn't return until predicts can see the new data
+        :return: A conformation message with a 201 if it was successful, otherwise an error message with the appropriate code.  If a row is malformed the rows before it are still added and a 400 says how many
         """
         # Get the model and parse the json lines
-        model = list(self.db.find({DATA_TYPE: DATA_TYPE_MODEL, ID: model_id}))
+        model = list(self.models.find({ID: model_id}, projection={BULK_ADD_MODEL_DATA: True}))
         if len(model) < 1:
             return "The given model was not found", 404
         if len(model) > 1:
             return "More than one model was found with the id", 500
         model = model[0][BULK_ADD_MODEL_DATA]
-        # Get all of the data in each column
+
+        # Find the columns the data of each node goes into
+        node_columns = {}
         for n in model[BAC_GRAPH][BAC_NODES]:
-            column_data = []
-            for line in data:
-                if n.get(BAC_COLUMN_NAME):
-                    column_data.append(line[n[BAC_COLUMN_NAME]])
-            # Add it to the db
-            if n.get(BAC_USER_SEMANTIC_TYPES):
-                for ust in n[BAC_USER_SEMANTIC_TYPES]:
-                    result = self.semantic_types_column_data_post_put(
-                        get_column_id(get_type_id(ust[BAC_CLASS][BAC_URI], ust[BAC_PROPERTY][BAC_URI]),
-                                      n[BAC_COLUMN_NAME], model[BAC_NAME], column_model), column_data, False)[1]
-                    if result == 201:
+            if n.get(BAC_COLUMN_NAME) and n.get(BAC_USER_SEMANTIC_TYPES):
+                # Nodes can share a column name, in which case the data goes into the columns of all of them
+                node_columns.setdefault(n[BAC_COLUMN_NAME], []).extend(
+                    get_column_id(get_type_id(ust[BAC_CLASS][BAC_URI], ust[BAC_PROPERTY][BAC_URI]),
+                                  n[BAC_COLUMN_NAME], model[BAC_NAME], column_model)
+                    for ust in n[BAC_USER_SEMANTIC_TYPES])
+        column_ids = set(column_id for ids in node_columns.values() for column_id in ids)
+        if len(list(self.columns.find({ID: {"$in": list(column_ids)}}, projection={ID: True}))) < len(column_ids):
+            return "A required column was not found", 404
+
+        # Go through the rows once, putting each value in its node's buffer, and write a buffer whenever it gets big
+        buffers = dict((name, []) for name in node_columns)
+
+        def flush(names):
+            appends = [(column_id, buffers[name]) for name in names for column_id in node_columns[name]]
+            if not self._append_values(appends):
+                return False
+            if job is not None: job.columns_written.update(column_id for column_id, _ in appends)
+            for name in names:
+                buffers[name] = []
+            return True
+
+        # The rows read before anything goes wrong are always written and crunched, so a retry only needs the rest
+        rows_added = 0
+        error = None
+        found = True
+        try:
+            for rows, line in enumerate(data, 1):
+                if job is not None: job.rows = rows
+                if not isinstance(line, dict):
+                    error = "Row %d is not a json object" % rows
+                    break
+                for name, value in line.items():
+                    buffer = buffers.get(name)
+                    if buffer is None:
                         continue
-                    elif result == 404:
-                        return "A required column was not found", 404
-                    else:
-                        return "Error occurred while adding data to the column", 500
-
+                    buffer.append(value)
+                    if len(buffer) >= BULK_ADD_FLUSH_SIZE and not flush([name]):
+                        found = False
+                        break
+                if not found:
+                    break
+                rows_added = rows
+        except JsonLinesError as e:
+            error = str(e)
+        finally:
+            # Whatever is left of every column is written together, so it is indexed with one bulk request
+            if found and not flush([name for name in buffers if buffers[name]]):
+                found = False
+            if wait_for_visibility: self.indexer.refresh(INDEX_NAME)
+            self._queue_crunch({ID: model_id})
+        if not found:
+            return "A required column was not found", 404
+        if error is not None:
+            return "%s, the %d rows before it were added" % (error, rows_added), 400
         return "Data successfully added to columns", 201
+
+    @server_method
+    def bulk_add_model_data_job_post(self, model_id, column_model, stream, wait_for_visibility=False):
+        """
+        Add data to the service with a bulk add model in the background, the same as bulk_add_model_data_post
+
+        :param model_id:            The id of the model to add off of
+        :param column_model:        The model of the columns being used with that model
+        :param stream:              File like object of the json lines of the data to add, such as the request body
+        :param wait_for_visibility: True if the job shouldn't finish until predicts can see the new data
+        :return: The status of the job which adds the data with a 202, otherwise an error message with the appropriate code
+        """
+        if self.models.find_one({ID: model_id}, projection={ID: True}) is None:
+            return "The given model was not found", 404
+        # The request is over by the time the job reads the body, so it is copied out first
+        body = tempfile.SpooledTemporaryFile(max_size=JOB_SPOOL_SIZE)
+        shutil.copyfileobj(stream, body)
+        body.seek(0)
+
+        def add_data(job):
+            try:
+                return self.bulk_add_model_data_post(model_id, column_model, json_lines(body), job,
+                                                     wait_for_visibility)
+            finally:
+                body.close()
+
+        return json_response(self.jobs.submit("bulk_add_model_data", add_data).to_json(), 202)
+
+    ################ Jobs ################
+
+    @server_method
+    def job_get(self, job_id):
+        """
+        Returns the status of a background job.
+
+        :param job_id: The id of the job
+        :return: The state and progress of the job with a 200, or a 404 if there is no job with the id
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return "No job with that id was found", 404
+        return json_response(job.to_json(), 200)
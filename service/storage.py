@@ -0,0 +1,340 @@
+import collections
+import logging
+import random
+import time
+
+from bson import ObjectId
+from pymongo import ASCENDING, ReplaceOne, ReturnDocument, UpdateOne
+
+from service import *
+from service.metrics import InstrumentedCollection
+
+logger = logging.getLogger(__name__)
+
+# The indexes each collection needs, as (keys, options) pairs.  The ids of the documents are indexed by MongoDB.
+INDEXES = {
+    TYPES_COLLECTION: [
+        ([(NAMESPACE, ASCENDING)], {}),
+        ([(CLASS, ASCENDING), (PROPERTY, ASCENDING)], {})
+    ],
+    COLUMNS_COLLECTION: [
+        # Filters on the columns of one semantic type, which is what most of the column endpoints do
+        ([(TYPE_ID, ASCENDING), (SOURCE_NAME, ASCENDING), (COLUMN_NAME, ASCENDING), (MODEL, ASCENDING)], {}),
+        ([(SOURCE_NAME, ASCENDING)], {}),
+        # The models filter of predict only needs the type ids of the columns, so this covers it
+        ([(MODEL, ASCENDING), (TYPE_ID, ASCENDING)], {}),
+        ([(COLUMN_NAME, ASCENDING)], {})
+    ],
+    MODELS_COLLECTION: [
+        ([(NAME, ASCENDING)], {})
+    ],
+    COLUMN_CHUNKS_COLLECTION: [
+        ([(COLUMN_ID, ASCENDING), (CHUNK_NUMBER, ASCENDING)], {"unique": True})
+    ]
+}
+
+# Which collection each kind of document in the legacy collection belongs in
+LEGACY_DATA_TYPES = {
+    DATA_TYPE_SEMANTIC_TYPE: TYPES_COLLECTION,
+    DATA_TYPE_COLUMN: COLUMNS_COLLECTION,
+    DATA_TYPE_MODEL: MODELS_COLLECTION
+}
+
+
+def _chunks(values, size):
+    """
+    Splits the values into lists of at most size values, without holding more than one list in memory at once.
+    """
+    chunk = []
+    for value in values:
+        chunk.append(value)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Storage(object):
+    """
+    The MongoDB collections of the service, one for each kind of document.  Each collection is wrapped so the
+    operations done on it show up in the metrics.
+
+    Notes: The values of a column are not stored in the column's document but in chunks of CHUNK_SIZE values (like
+    GridFS does with files), so a column can be as big as needed and adding values to it never has to rewrite the
+    values which are already stored.  The column's document keeps the number of values added to it, which is also
+    where the next value goes: value i is in chunk i // CHUNK_SIZE.
+    """
+
+    def __init__(self, mongo_client):
+        """
+        :param mongo_client: The client of the MongoDB to store everything in
+        """
+        self.database = mongo_client[DATABASE_NAME]
+        self.types = InstrumentedCollection(self.database[TYPES_COLLECTION])
+        self.columns = InstrumentedCollection(self.database[COLUMNS_COLLECTION])
+        self.models = InstrumentedCollection(self.database[MODELS_COLLECTION])
+        self.column_chunks = InstrumentedCollection(self.database[COLUMN_CHUNKS_COLLECTION])
+
+    def collection(self, name):
+        """
+        Returns one of the collections by its name.
+
+        :param name: One of TYPES_COLLECTION, COLUMNS_COLLECTION, MODELS_COLLECTION or COLUMN_CHUNKS_COLLECTION
+        :return: The collection
+        """
+        return {TYPES_COLLECTION: self.types, COLUMNS_COLLECTION: self.columns, MODELS_COLLECTION: self.models,
+                COLUMN_CHUNKS_COLLECTION: self.column_chunks}[name]
+
+    def ensure_indexes(self):
+        """
+        Creates the indexes the queries of the service need, any which already exist are left as they are.
+        """
+        for name, indexes in INDEXES.items():
+            collection = self.collection(name)
+            for keys, options in indexes:
+                collection.create_index(keys, **options)
+
+    def write_values(self, column_id, values):
+        """
+        Stores the values of a column which doesn't have any yet.
+
+        :param column_id: Id of the column
+        :param values:    Iterable of the values to store
+        :return: The number of values written
+        """
+        chunks = [{COLUMN_ID: column_id, CHUNK_NUMBER: i, COLUMN_VALUES: chunk}
+                  for i, chunk in enumerate(_chunks(values, CHUNK_SIZE))]
+        if chunks:
+            self.column_chunks.insert_many(chunks, ordered=False)
+        return sum(len(chunk[COLUMN_VALUES]) for chunk in chunks)
+
+    def append_values(self, column_id, values, sample_size=SAMPLE_SIZE):
+        """
+        Adds values to a column, keeping a uniform random sample of at most sample_size of all of the values ever added
+        to it (reservoir sampling).  Until the column is full the values are added to its end, after that each value
+        replaces a random one of the stored values with the chance of it being in a sample of everything seen so far.
+
+        This is done with atomic updates in MongoDB, one which reserves the positions of the values by adding them to
+        the column's valueCount and then one bulk write which pushes or sets them in their chunks, so the values already
+        in the column are never read and appends which run at the same time never lose each other's values.  It takes
+        those two requests since the chunks a value goes into (and whether it replaces one) depend on its position,
+        which is only known once the reserving update has returned the valueCount before it, and the column and its
+        chunks are separate documents which one MongoDB update can't change together.
+
+        :param column_id:   Id of the column
+        :param values:      List of the values to add
+        :param sample_size: The most values the column holds, 0 to keep every value
+        :return: The list of the values added to the end of the column and a dictionary of the positions of the values
+                 which were replaced to their new values, or None if there is no column with the id.  A replacement
+                 is only in the dictionary if it was made, so it can be applied to the search index as it is
+        """
+        column = self.columns.find_one_and_update({ID: column_id}, {"$inc": {VALUE_COUNT: len(values)},
+                                                                    "$set": {DATA_VERSION: ObjectId()}},
+                                                  projection={VALUE_COUNT: True})
+        if column is None:
+            return None
+        offset = column.get(VALUE_COUNT, 0)
+        appended = values[:max(0, sample_size - offset)] if sample_size else values
+        replacements = {}
+        for i in range(offset + len(appended), offset + len(values)):
+            j = random.randint(0, i)
+            if j < sample_size:
+                replacements[j] = values[i - offset]
+        updates = self._push_updates(column_id, offset, appended) + self._replace_updates(column_id, replacements)
+        if updates:
+            # Ordered, since some of the replacements can be of values pushed by this same write
+            result = self.column_chunks.bulk_write(updates, ordered=True)
+            # Every push matches or creates its chunk, so anything short is a replacement which didn't match
+            if result.matched_count + result.upserted_count < len(updates):
+                replacements = self._replace_when_pushed(column_id, replacements)
+        return appended, replacements
+
+    def _chunk_sizes(self, column_id, chunk_numbers):
+        return dict((chunk[CHUNK_NUMBER], chunk["size"]) for chunk in self.column_chunks.aggregate([
+            {"$match": {COLUMN_ID: column_id, CHUNK_NUMBER: {"$in": list(chunk_numbers)}}},
+            {"$project": {CHUNK_NUMBER: True, "size": {"$size": "$" + COLUMN_VALUES}}}]))
+
+    def _replace_when_pushed(self, column_id, replacements):
+        """
+        Replaces the values at positions which another append has reserved but hadn't pushed yet, once it has.
+
+        :param column_id:    Id of the column
+        :param replacements: Dictionary of the positions of the values to replace to their new values
+        :return: The replacements which were made, the ones whose positions still weren't pushed after waiting
+                 REPLACE_WAIT_ATTEMPTS times are dropped
+        """
+        chunk_numbers = set(position // CHUNK_SIZE for position in replacements)
+        for attempt in range(REPLACE_WAIT_ATTEMPTS):
+            if attempt:
+                time.sleep(REPLACE_WAIT_SECONDS)
+            sizes = self._chunk_sizes(column_id, chunk_numbers)
+            pushed = dict((position, value) for position, value in replacements.items()
+                          if position % CHUNK_SIZE < sizes.get(position // CHUNK_SIZE, 0))
+            if len(pushed) == len(replacements):
+                break
+        else:
+            logger.warning("Dropped %d replaced values of column %s whose positions were never pushed",
+                           len(replacements) - len(pushed), column_id)
+        # Values are only ever pushed onto the end of a chunk, so these positions are still there to be set
+        if pushed:
+            self.column_chunks.bulk_write(self._replace_updates(column_id, pushed), ordered=False)
+        return pushed
+
+    @staticmethod
+    def _push_updates(column_id, offset, values):
+        updates = []
+        start = 0
+        while start < len(values):
+            chunk_number = (offset + start) // CHUNK_SIZE
+            end = min((chunk_number + 1) * CHUNK_SIZE - offset, len(values))
+            updates.append(UpdateOne({COLUMN_ID: column_id, CHUNK_NUMBER: chunk_number},
+                                     {"$push": {COLUMN_VALUES: {"$each": values[start:end]}}}, upsert=True))
+            start = end
+        return updates
+
+    @staticmethod
+    def _replace_updates(column_id, replacements):
+        chunks = collections.defaultdict(dict)
+        for position, value in replacements.items():
+            chunks[position // CHUNK_SIZE][position % CHUNK_SIZE] = value
+        updates = []
+        for chunk_number, chunk in chunks.items():
+            # A value which another append has reserved but not pushed yet is left alone rather than padding the chunk
+            last = "%s.%d" % (COLUMN_VALUES, max(chunk))
+            updates.append(UpdateOne({COLUMN_ID: column_id, CHUNK_NUMBER: chunk_number, last: {"$exists": True}},
+                                     {"$set": dict(("%s.%d" % (COLUMN_VALUES, i), value)
+                                                   for i, value in chunk.items())}))
+        return updates
+
+    def replace_values(self, column_id, values, sample_size=SAMPLE_SIZE):
+        """
+        Replaces all of the values of a column.
+
+        :param column_id:   Id of the column
+        :param values:      List of the new values
+        :param sample_size: The most values the column holds, a random sample of the values is kept if there are more
+        :return: The column's document with the values which were stored, or None if there is no column with the id
+        """
+        column = self.columns.find_one_and_update({ID: column_id},
+                                                  {"$set": {VALUE_COUNT: len(values), DATA_VERSION: ObjectId()}},
+                                                  return_document=ReturnDocument.AFTER)
+        if column is None:
+            return None
+        if sample_size and len(values) > sample_size:
+            values = random.sample(values, sample_size)
+        self.delete_values([column_id])
+        self.write_values(column_id, values)
+        column[COLUMN_VALUES] = values
+        return column
+
+    def oversized_columns(self, sample_size=SAMPLE_SIZE):
+        """
+        Finds the columns which hold more than sample_size values, such as the ones created before columns were sampled
+        as values are added to them.
+
+        :param sample_size: The most values a column should hold
+        :return: A list of the ids of the columns
+        """
+        pipeline = [{"$group": {ID: "$" + COLUMN_ID, "count": {"$sum": {"$size": "$" + COLUMN_VALUES}}}},
+                    {"$match": {"count": {"$gt": sample_size}}}]
+        return [group[ID] for group in self.column_chunks.aggregate(pipeline, allowDiskUse=True)]
+
+    def compact_values(self, column_id, sample_size=SAMPLE_SIZE):
+        """
+        Replaces the values of a column with a uniform random sample of them.  The column's valueCount is left as it is,
+        so values added later are still sampled against everything that was ever added.
+
+        :param column_id:   Id of the column
+        :param sample_size: The most values the column holds
+        :return: The values which were kept
+        """
+        values = reservoir_sample(self.read_values(column_id), sample_size)
+        self.delete_values([column_id])
+        self.write_values(column_id, values)
+        self.columns.update_one({ID: column_id}, {"$set": {DATA_VERSION: ObjectId()}})
+        return values
+
+    def read_values(self, column_id):
+        """
+        Streams the values of a column back in the order they were stored, one chunk at a time.
+
+        :param column_id: Id of the column
+        :return: A generator of the values
+        """
+        for chunk in self.column_chunks.find({COLUMN_ID: column_id}, projection={ID: False, COLUMN_VALUES: True},
+                                             sort=[(CHUNK_NUMBER, ASCENDING)]):
+            for value in chunk[COLUMN_VALUES]:
+                yield value
+
+    def with_values(self, columns, batch_size=COLUMN_BATCH_SIZE):
+        """
+        Adds the values of each column to its document, the chunks of batch_size columns are loaded with one query.
+
+        :param columns:    Iterable of column documents
+        :param batch_size: The number of columns to load the values of at once
+        :return: A generator of the column documents with their values
+        """
+        for batch in _chunks(columns, batch_size):
+            values = dict((column[ID], []) for column in batch)
+            for chunk in self.column_chunks.find({COLUMN_ID: {"$in": list(values)}},
+                                                 projection={ID: False, COLUMN_ID: True, COLUMN_VALUES: True},
+                                                 sort=[(COLUMN_ID, ASCENDING), (CHUNK_NUMBER, ASCENDING)]):
+                values[chunk[COLUMN_ID]].extend(chunk[COLUMN_VALUES])
+            for column in batch:
+                column[COLUMN_VALUES] = values[column[ID]]
+                yield column
+
+    def delete_values(self, column_ids):
+        """
+        Deletes all of the values of the columns.
+
+        :param column_ids: List of the ids of the columns
+        """
+        self.column_chunks.delete_many({COLUMN_ID: {"$in": list(column_ids)}})
+
+    def chunk_inline_values(self):
+        """
+        Moves the values of the columns which still have them in their documents, as every column did before the values
+        were stored in chunks, into chunks.
+
+        :return: The number of columns whose values were moved
+        """
+        moved = 0
+        for column in self.columns.find({COLUMN_VALUES: {"$exists": True}}, projection={COLUMN_VALUES: True}):
+            # Clears any chunks left over from an earlier run which was interrupted
+            self.delete_values([column[ID]])
+            value_count = self.write_values(column[ID], column[COLUMN_VALUES] or [])
+            self.columns.update_one({ID: column[ID]}, {"$unset": {COLUMN_VALUES: ""}, "$set": {VALUE_COUNT: value_count}})
+            moved += 1
+        return moved
+
+    def migrate_legacy(self, batch_size=MIGRATION_BATCH_SIZE):
+        """
+        Copies every document in the legacy collection into the collection for its kind.  Documents which were
+        already copied are replaced, so this can be run again if it is interrupted.
+
+        :param batch_size: The number of documents written to a collection at once
+        :return: A dictionary of the number of documents copied into each collection
+        """
+        legacy = self.database[LEGACY_COLLECTION]
+        batches = dict((name, []) for name in LEGACY_DATA_TYPES.values())
+        counts = dict((name, 0) for name in LEGACY_DATA_TYPES.values())
+
+        def flush(name):
+            if batches[name]:
+                self.collection(name).bulk_write(batches[name], ordered=False)
+                counts[name] += len(batches[name])
+                batches[name] = []
+
+        for doc in legacy.find():
+            name = LEGACY_DATA_TYPES.get(doc.pop(DATA_TYPE, None))
+            if name is None:
+                logger.warning("Skipped the document %s since it doesn't have a known %s", doc.get(ID), DATA_TYPE)
+                continue
+            batches[name].append(ReplaceOne({ID: doc[ID]}, doc, upsert=True))
+            if len(batches[name]) >= batch_size:
+                flush(name)
+        for name in batches:
+            flush(name)
+        return counts
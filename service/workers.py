@@ -0,0 +1,99 @@
+import multiprocessing
+import threading
+import time
+
+from semantic_labeling.lib.column import Column
+from semantic_labeling.main.random_forest import MyRandomForest
+
+from service import *
+from service.search import create_search_backend
+
+# The classifier and searcher of a worker process, loaded once when the worker starts
+worker_classifier = None
+worker_searcher = None
+
+
+def _init_worker(model_path, search_backend):
+    global worker_classifier, worker_searcher
+    worker_classifier = MyRandomForest({}, {}, model_path)
+    worker_classifier.train([])
+    worker_searcher = create_search_backend(search_backend)[1]
+
+
+def prepare_column(column_name, source_name, data):
+    """
+    Creates a column out of the data values and extracts its features so it is ready to be predicted.
+
+    :param column_name: Name of the column
+    :param source_name: Name of the source of the column
+    :param data:        The data values of the column
+    :return: The prepared Column
+    """
+    att = Column(column_name, source_name)
+    for value in data:
+        att.add_value(value)
+    att.semantic_type = "to_predict"
+    att.prepare_data()
+    return att
+
+
+def predict_column(column_name, source_names, data, allowed_ids=None):
+    """
+    Predicts the semantic type of a column with the worker's own searcher and classifier, so nothing but the data has
+    to be sent to the worker and nothing but the predictions sent back.
+
+    :param column_name:  Name of the column
+    :param source_names: List of source names
+    :param data:         The data values of the column
+    :param allowed_ids:  Set of the semantic type ids which may be predicted, None if all of them may be
+    :return: The predictions of the semantic labeler and how long each stage of the predict took, in the form
+             (predictions, [(stage, seconds), ...])
+    """
+    stage_times = []
+
+    def timed(stage, func, *args):
+        start = time.time()
+        result = func(*args)
+        stage_times.append((stage, time.time() - start))
+        return result
+
+    att = timed("prepare", prepare_column, column_name, source_names[0], data)
+    text_data = timed("text_search", worker_searcher.search_similar_text_data, INDEX_NAME, att.value_text,
+                      source_names, allowed_ids)
+    types_data = timed("types_search", worker_searcher.search_types_data, INDEX_NAME, source_names, allowed_ids)
+    return timed("classifier", att.predict_type, types_data, text_data, worker_classifier), stage_times
+
+
+class PredictionPool(object):
+    """
+    A pool of worker processes which each predict a whole column, so predicts can use every core.  Each worker loads
+    its own copy of the classifier and connects to the search backend when it starts, so the backend has to be one
+    which every process can reach (not the memory backend).
+
+    Notes: At most max_pending tasks are sent to the workers at once, any more will wait for one of them to finish.
+    """
+
+    def __init__(self, processes=PREDICT_PROCESSES, max_pending=PREDICT_MAX_PENDING, search_backend=SEARCH_BACKEND):
+        self._pool = multiprocessing.Pool(processes, _init_worker, (DATA_MODEL_PATH, search_backend))
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def run(self, func, *args):
+        """
+        Runs a function in one of the workers and waits for the result.
+
+        :param func: A module level function in this file, such as predict_column
+        :param args: The arguments of the function, these must be picklable
+        :return: The return value of the function
+        """
+        self._slots.acquire()
+        try:
+            return self._pool.apply_async(func, args).get()
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """
+        Stops all of the workers.
+        """
+        self._pool.terminate()
+        self._pool.join()